@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+INDEX_VERSION = 1
+
+# Objects not in the index are removed by evict() once they are this old, younger
+# ones may belong to a put() of another process.
+ORPHAN_AGE = 3600
+
+
+class Cache(object):
+    '''Content-addressed download cache.
+
+    Files are stored as objects/<sha256>, index.json maps every url to
+    {'sha256', 'size', 'etag', 'last_modified', 'last_used'}. The hash is
+    computed once while downloading, a cached file is trusted when it exists
+    and has the recorded size. Partial downloads in tmp/ and the parsed
+    images in images/ (see bcf.flasher.image) count into the cache size too.
+    '''
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        self._objects_dir = os.path.join(cache_dir, 'objects')
+        self._tmp_dir = os.path.join(cache_dir, 'tmp')
+        self._index_file = os.path.join(cache_dir, 'index.json')
+        self._index = None
+        self._lock = threading.RLock()
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+
+        self._index = {}
+        try:
+            with open(self._index_file, 'r', encoding='utf-8') as fd:
+                data = json.load(fd)
+            if data.get('version') == INDEX_VERSION:
+                self._index = data['urls']
+        except Exception:
+            pass
+
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'urls': self._index}, f)
+        os.replace(tmp, self._index_file)
+
+    def object_path(self, sha256):
+        return os.path.join(self._objects_dir, sha256)
+
+    def entry(self, url):
+        with self._lock:
+            return self._load_index().get(url)
+
+    def _valid_path(self, entry):
+        if not entry:
+            return None
+        path = self.object_path(entry['sha256'])
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return None
+        except OSError:
+            return None
+        return path
+
+    def has(self, url):
+        '''Return whether url is cached, unlike get() without recording the use.'''
+        with self._lock:
+            return self._valid_path(self._load_index().get(url)) is not None
+
+    def get(self, url):
+        '''Return path of the cached file for url or None.'''
+        with self._lock:
+            entry = self._load_index().get(url)
+            path = self._valid_path(entry)
+            if not path:
+                return None
+
+            entry['last_used'] = time.time()
+            self._save_index()
+
+            return path
+
+    def download(self, url, transport, revalidate=False, reporthook=None):
+        '''Download url into the cache and return path of the file.
+
+        A cached file is returned without network access, unless revalidate is
+        set, then it is checked by If-None-Match/If-Modified-Since. Interrupted
+        transfer is kept in tmp/<hash of url>.part and resumed by Range request.
+        reporthook is called as reporthook(1, done, total) when total is known.
+        '''
+        path = self.get(url)
+        if path and not revalidate:
+            return path
+
+        headers = {}
+        if path:
+            entry = self.entry(url)
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        key = hashlib.sha256(url.encode()).hexdigest()
+        part = os.path.join(self._tmp_dir, key + '.part')
+        part_meta = os.path.join(self._tmp_dir, key + '.json')
+
+        offset = 0
+        validator = None
+        if os.path.exists(part):
+            try:
+                with open(part_meta, 'r', encoding='utf-8') as fd:
+                    validator = json.load(fd)['validator']
+                offset = os.path.getsize(part)
+            except Exception:
+                offset = 0
+
+        if offset and validator:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+
+        response = transport.get(url, headers=headers)
+        try:
+            if response.status_code == 304 and path:
+                self.get(url)
+                return path
+
+            if response.status_code == 416:
+                os.unlink(part)
+                response.close()
+                return self.download(url, transport, revalidate, reporthook)
+
+            if response.status_code < 200 or response.status_code >= 300:
+                raise Exception("Response status_code=%d" % response.status_code)
+
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+            sha256 = hashlib.sha256()
+
+            if response.status_code == 206:
+                with open(part, 'rb') as f:
+                    for data in iter(lambda: f.read(65536), b''):
+                        sha256.update(data)
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+                os.makedirs(self._tmp_dir, exist_ok=True)
+                with open(part_meta, 'w', encoding='utf-8') as fd:
+                    json.dump({'url': url, 'validator': etag if etag and not etag.startswith('W/') else last_modified}, fd)
+
+            total = response.headers.get('content-length')
+            if total is not None:
+                total = int(total) + offset
+
+            size = offset
+            with open(part, mode) as f:
+                for data in response.iter_content(chunk_size=4096):
+                    f.write(data)
+                    sha256.update(data)
+                    size += len(data)
+                    if reporthook and total:
+                        reporthook(1, size, total)
+        finally:
+            response.close()
+
+        if total is not None and size != total:
+            raise Exception('Incomplete download %d of %d bytes' % (size, total))
+
+        path = self.put(url, part, sha256.hexdigest(), size, etag, last_modified)
+
+        try:
+            os.unlink(part_meta)
+        except OSError:
+            pass
+
+        return path
+
+    def put(self, url, tmp_path, sha256, size, etag=None, last_modified=None):
+        '''Move downloaded tmp_path into the store and record it for url.'''
+        os.makedirs(self._objects_dir, exist_ok=True)
+        path = self.object_path(sha256)
+
+        with self._lock:
+            os.replace(tmp_path, path)
+
+            index = self._load_index()
+            old = index.get(url)
+            index[url] = {
+                'sha256': sha256,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'last_used': time.time()
+            }
+            self._save_index()
+
+            # Content of url changed, drop the previous object unless shared.
+            if old and old['sha256'] != sha256 and not any(entry['sha256'] == old['sha256'] for entry in index.values()):
+                try:
+                    os.unlink(self.object_path(old['sha256']))
+                except OSError:
+                    pass
+
+        return path
+
+    def pin(self, url, pinned=True):
+        '''Pinned files are never evicted.'''
+        with self._lock:
+            entry = self._load_index().get(url)
+            if not entry:
+                raise Exception('Url is not in cache.')
+            entry['pinned'] = pinned
+            self._save_index()
+
+    def evict(self, max_size=None, max_age=None, keep=None):
+        '''Remove files not used for max_age seconds, then the least recently used files until the cache fits into max_size bytes.
+
+        Pinned files and the file with sha256 keep are never removed. Files in
+        tmp/ and images/ are evicted the same way by their modification time,
+        objects missing in the index are removed.
+        '''
+        with self._lock:
+            index = self._load_index()
+            now = time.time()
+
+            objects = {}
+            for url, entry in index.items():
+                obj = objects.setdefault(entry['sha256'], {'path': self.object_path(entry['sha256']), 'size': entry['size'], 'last_used': 0, 'pinned': False, 'urls': []})
+                obj['last_used'] = max(obj['last_used'], entry['last_used'])
+                obj['pinned'] = obj['pinned'] or entry.get('pinned', False)
+                obj['urls'].append(url)
+
+            for name in _listdir(self._objects_dir):
+                path = os.path.join(self._objects_dir, name)
+                if name not in objects and now - _stat(path, 'st_mtime', now) > ORPHAN_AGE:
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+
+            files = list(objects.values())
+            for directory in (self._tmp_dir, os.path.join(self._cache_dir, 'images')):
+                for name in _listdir(directory):
+                    path = os.path.join(directory, name)
+                    files.append({'path': path, 'size': _stat(path, 'st_size', 0), 'last_used': _stat(path, 'st_mtime', now), 'pinned': False, 'urls': []})
+
+            total = sum(f['size'] for f in files)
+            removed = False
+
+            for f in sorted(files, key=lambda f: f['last_used']):
+                expired = max_age and now - f['last_used'] > max_age
+                if not expired and (not max_size or total <= max_size):
+                    continue
+                if f['pinned'] or (keep and f['path'] == self.object_path(keep)):
+                    continue
+
+                try:
+                    os.unlink(f['path'])
+                except OSError:
+                    pass
+
+                for url in f['urls']:
+                    del index[url]
+                    removed = True
+
+                total -= f['size']
+
+            if removed:
+                self._save_index()
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except OSError:
+        return []
+
+
+def _stat(path, field, default):
+    try:
+        return getattr(os.stat(path), field)
+    except OSError:
+        return default
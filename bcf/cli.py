@@ -4,20 +4,13 @@ from __future__ import print_function, unicode_literals
 import click
 import os
 import sys
-import glob
-import tempfile
-import zipfile
-import shutil
-import subprocess
-import serial
-import platform
-import re
-from packaging import version
-from bcf import flasher
 from bcf.log import log as bcflog
 from bcf.utils import *
-import bcf.firmware.utils as futils
-from bcf import ftdi
+
+format_option = click.option('--format', 'output_format', type=click.Choice(OUTPUT_FORMATS), default='table', show_default=True, help='Output format, json, jsonl and tsv are streamed row by row.')
+
+# Heavy modules (serial, requests, yaml, intelhex, pyftdi) are imported inside
+# the commands which need them, so --help and shell completion start fast.
 
 
 __version__ = '@@VERSION@@'
@@ -34,37 +27,34 @@ VSCODE_URL_ZIP = 'https://codeload.github.com/hardwario/bcf-vscode/zip/master'
 def cli(ctx, device=None):
     '''HARDWARIO TOWER Firmware Tool.'''
     ctx.obj['device'] = device
-    if not os.path.exists(user_cache_dir):
-        os.makedirs(user_cache_dir)
 
 
 @cli.command('clean')
 def command_clean():
     '''Clean cache.'''
-    fwlist = get_fwlist()
-    fwlist.clear()
+    import shutil
+    if not os.path.exists(user_cache_dir):
+        return
     for filename in os.listdir(user_cache_dir):
-        os.unlink(os.path.join(user_cache_dir, filename))
+        path = os.path.join(user_cache_dir, filename)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
 
 
 def _create_get_firmware_list(ctx, args, incomplete):
     if 'bigclownlabs/bcf-skeleton'.startswith(incomplete):
-        return ['bigclownlabs/bcf-skeleton'] + get_fwlist().get_firmware_list(startswith=incomplete, add_latest=False)
+        return ['bigclownlabs/bcf-skeleton'] + complete_firmware(incomplete, versions=False)
     else:
-        return get_fwlist().get_firmware_list(startswith=incomplete, add_latest=False)
+        return complete_firmware(incomplete, versions=False)
 
 
 def _flash_get_firmware_list(ctx, args, incomplete):
-    files = list(filter(lambda name: name.startswith(incomplete), glob.glob('*.bin')))
-    return files + get_fwlist().get_firmware_list(startswith=incomplete)
-
+    return complete_files(incomplete, ('.bin', '.hex', '.elf')) + complete_firmware(incomplete)
 
-fwAutocompleteteArgs = {}
 
-if version.parse(click.__version__) >= version.Version('8.1'):
-    fwAutocompleteteArgs['shell_complete'] = _flash_get_firmware_list
-else:
-    fwAutocompleteteArgs['autocompletion'] = _flash_get_firmware_list
+fwAutocompleteteArgs = {'shell_complete': _flash_get_firmware_list}
 
 
 @cli.command('create')
@@ -74,6 +64,10 @@ else:
 @click.option('--depth', 'depth', help='Set git submodule clone depth.')
 def command_create(name, no_git, _from, depth):
     '''Create new firmware.'''
+    import re
+    import shutil
+    import tempfile
+    import zipfile
 
     if os.path.exists(name):
         print('Directory already exists')
@@ -139,8 +133,13 @@ def command_create(name, no_git, _from, depth):
 @cli.command('devices')
 @click.option('-v', '--verbose', is_flag=True, help='Show more messages.')
 @click.option('-s', '--include-links', is_flag=True, help='Include entries that are symlinks to real devices.')
-def command_devices(verbose=False, include_links=False):
+@format_option
+def command_devices(verbose=False, include_links=False, output_format='table'):
     '''Print available devices.'''
+    if output_format != 'table':
+        print_rows(('port', 'desc', 'hwid'), get_devices(include_links), output_format)
+        return
+
     for port, desc, hwid in get_devices(include_links):
         sys.stdout.write("{:20}\n".format(port))
         if verbose:
@@ -148,32 +147,76 @@ def command_devices(verbose=False, include_links=False):
             sys.stdout.write("    hwid: {}\n".format(hwid))
 
 
+def _parse_int(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return int(value, 0)
+    except ValueError:
+        raise click.BadParameter('%s is not a valid integer' % value)
+
+
+def _parse_patch(ctx, param, value):
+    patches = []
+    for item in value:
+        try:
+            address, data = item.split('=', 1)
+            patches.append((int(address, 0), bytes.fromhex(data)))
+        except ValueError:
+            raise click.BadParameter('%s is not in format offset=hex' % item)
+    return patches
+
+
 @cli.command('eeprom')
 @click.option('-d', '--device', type=str, help='Device path.')
 @click.option('--read', type=str, help='Read EEPROM and save to file.', metavar='FILE')
 @click.option('--erase', is_flag=True, help='Erase EEPROM.')
 @click.option('--write', type=str, help='Read file adn write to EEPROM.', metavar='FILE')
+@click.option('--address', type=str, help='Start address for read and write (default 0).', default='0', callback=_parse_int)
+@click.option('--length', type=str, help='Length for read and write (default to the end of EEPROM).', callback=_parse_int)
+@click.option('--patch', type=str, multiple=True, help='Write bytes at offset, for example 0x10=0102ab.', metavar='OFFSET=HEX', callback=_parse_patch)
 @click.option('--dfu', is_flag=True, help='Use dfu mode.')
 @click.pass_context
-def command_eeprom(ctx, device, read, erase, write, dfu):
+def command_eeprom(ctx, device, read, erase, write, address, length, patch, dfu):
     '''Work with EEPROM.'''
+    from bcf import flasher
     if device is None:
         device = ctx.obj['device']
 
-    if not read and not erase and not write:
+    if not read and not erase and not write and not patch:
         click.echo(ctx.get_help())
         return
 
+    if length is None:
+        length = 6144 - address
+
     device = select_device('dfu' if dfu else device)
 
     if read:
-        flasher.eeprom_read(device, read, address=0, length=6144, reporthook=print_progress_bar)
+        flasher.eeprom_read(device, read, address=address, length=length, reporthook=print_progress_bar)
 
     if erase:
         flasher.eeprom_erase(device, reporthook=print_progress_bar)
 
     if write:
-        flasher.eeprom_write(device, write, address=0, length=6144, reporthook=print_progress_bar)
+        flasher.eeprom_write(device, write, address=address, length=length, reporthook=print_progress_bar)
+
+    if patch:
+        flasher.eeprom_patch(device, patch, reporthook=print_progress_bar)
+
+
+def _get_firmware_filename(what):
+    if what.startswith('http'):
+        return download_url(what)
+
+    if os.path.exists(what) and os.path.isfile(what):
+        return what
+
+    fwlist = get_fwlist()
+    firmware = fwlist.get_firmware_version(what)
+    if not firmware:
+        raise Exception('Firmware not found, try updating first, command: bcf update')
+    return download_url(firmware['url'])
 
 
 @cli.command('flash')
@@ -186,38 +229,50 @@ def command_eeprom(ctx, device, read, erase, write, dfu):
 @click.option('--skip-verify', is_flag=True, help='Skip verify.')
 @click.option('--diff', is_flag=True, help='Flash only different pages.')
 @click.option('--slow', is_flag=True, help='Slow flash, same as --baudrate 115200.')
-@click.option('--baudrate', type=int, help='Baudrate (default 921600).', default=921600)
+@click.option('--baudrate', type=int, help='Baudrate (default 921600 or from manifest).')
+@click.option('--manifest', type=click.Path(exists=True, dir_okay=False), help='Flash firmware and EEPROM by manifest (YAML/JSON) in one session.', metavar='FILE')
 @bcflog.click_options
 @click.pass_context
-def command_flash(ctx, what, device, log, dfu, erase_eeprom, unprotect, skip_verify, diff, slow, baudrate, **args):
+def command_flash(ctx, what, device, log, dfu, erase_eeprom, unprotect, skip_verify, diff, slow, baudrate, manifest, **args):
     '''Flash firmware.'''
+    import platform
+    import subprocess
+    from bcf import flasher
+    import bcf.firmware.utils as futils
     if device is None:
         device = ctx.obj['device']
 
     if log and (dfu or device) == 'dfu':
         raise Exception("Sorry, Core Module r1.3 doesn't support log functionality.")
 
-    if what.startswith('http'):
-        filename = download_url(what)
+    eeprom = None
 
-    elif os.path.exists(what) and os.path.isfile(what):
-        filename = what
+    if manifest:
+        manifest = futils.load_manifest(manifest)
+        if ctx.get_parameter_source('what') != click.core.ParameterSource.DEFAULT:
+            if manifest.get('firmware'):
+                raise click.UsageError('Firmware given both as argument and in manifest.')
+        else:
+            what = manifest.get('firmware')
+        eeprom = manifest['eeprom']
+        erase_eeprom = erase_eeprom or manifest.get('erase_eeprom', False)
+        unprotect = unprotect or manifest.get('unprotect', False)
+        skip_verify = skip_verify or manifest.get('skip_verify', False)
+        diff = diff or manifest.get('diff', False)
+        if baudrate is None:
+            baudrate = manifest.get('baudrate')
 
-    else:
-        fwlist = get_fwlist()
-        firmware = fwlist.get_firmware_version(what)
-        if not firmware:
-            raise Exception('Firmware not found, try updating first, command: bcf update')
-            sys.exit(1)
-        filename = download_url(firmware['url'])
+    filename = _get_firmware_filename(what) if what else None
 
     try:
         device = select_device('dfu' if dfu else device)
 
         if slow:
             baudrate = 115200
+        elif baudrate is None:
+            baudrate = 921600
 
-        flasher.flash(filename, device, reporthook=print_progress_bar, run=not log, erase_eeprom=erase_eeprom, unprotect=unprotect, skip_verify=skip_verify, diff=diff, baudrate=baudrate)
+        flasher.flash(filename, device, reporthook=print_progress_bar, run=not log, erase_eeprom=erase_eeprom, unprotect=unprotect, skip_verify=skip_verify, diff=diff, baudrate=baudrate, eeprom=eeprom, cache_dir=user_cache_dir)
         if log:
             bcflog.run_args(device, args, reset=True)
 
@@ -267,13 +322,13 @@ def command_help(ctx, command):
 @click.option('--all', is_flag=True, help='Show all releases.')
 @click.option('--description', is_flag=True, help='Show description.')
 @click.option('--show-pre-release', is_flag=True, help='Show pre-release version.')
-def command_list(all=False, description=False, show_pre_release=False):
+@format_option
+def command_list(all=False, description=False, show_pre_release=False, output_format='table'):
     '''List firmware.'''
     fwlist = get_fwlist()
-    rows = fwlist.get_firmware_table(all=all, description=description, show_pre_release=show_pre_release)
-    if rows:
-        print_table([], rows)
-    else:
+    rows = fwlist.iter_firmware_table(all=all, description=description, show_pre_release=show_pre_release)
+    keys = ('firmware', 'description') if description else ('firmware',)
+    if not print_rows(keys, rows, output_format) and output_format == 'table':
         click.echo('Empty list, try: bcf update')
 
 
@@ -294,10 +349,15 @@ def command_log(ctx, device=None, log=False, **args):
 
 @cli.command('pull')
 @click.argument('what', metavar="<firmware from list|url>")
-def command_pull(what):
+@click.option('--pin', is_flag=True, help='Never evict pulled firmware from cache.')
+@click.option('-j', '--jobs', type=int, default=8, help='Number of parallel downloads for latest (default 8).')
+def command_pull(what, pin, jobs):
     '''Pull firmware to cache.'''
+    urls = []
+
     if what.startswith('http'):
         download_url(what, True)
+        urls.append(what)
     else:
 
         fwlist = get_fwlist()
@@ -305,25 +365,39 @@ def command_pull(what):
         if what in ('last', 'latest'):
             for name in fwlist.get_firmware_list():
                 firmware = fwlist.get_firmware_version(name)
-                click.echo('pull ' + name)
-                download_url(firmware['url'], True)
-                click.echo('')
+                if firmware:
+                    urls.append(firmware['url'])
+            download_urls(urls, jobs=jobs)
         else:
             firmware = fwlist.get_firmware_version(what)
             if not firmware:
                 print('Firmware not found, try updating first, command: bcf update')
                 sys.exit(1)
             download_url(firmware['url'])
+            urls.append(firmware['url'])
+
+    if pin:
+        from bcf.cache import Cache
+        cache = Cache(user_cache_dir)
+        for url in urls:
+            cache.pin(url)
+
+
+def _parse_length(ctx, param, value):
+    if value == 'auto':
+        return None
+    return _parse_int(ctx, param, value)
 
 
 @cli.command('read')
 @click.argument('filename')
 @click.option('-d', '--device', type=str, help='Device path.')
 @click.option('--dfu', is_flag=True, help='Use dfu mode.')
-@click.option('--length', help='length.', default=196608, type=int)
+@click.option('--length', help='Length in bytes, or auto to read only up to the end of programmed data.', default='196608', callback=_parse_length)
 @click.pass_context
 def command_read(ctx, filename, length, device=None, dfu=False):
-    '''Download firmware to file.'''
+    '''Download firmware to file (.bin or sparse .hex).'''
+    from bcf import flasher
     if device is None:
         device = ctx.obj['device']
 
@@ -339,6 +413,7 @@ def command_read(ctx, filename, length, device=None, dfu=False):
 @click.pass_context
 def command_reset(ctx, device=None, log=False, **args):
     '''Reset core module.'''
+    from bcf import flasher
     if device is None:
         device = ctx.obj['device']
 
@@ -358,20 +433,20 @@ def command_reset(ctx, device=None, log=False, **args):
 @click.option('--all', is_flag=True, help='Show all releases.')
 @click.option('--description', is_flag=True, help='Show description.')
 @click.option('--show-pre-release', is_flag=True, help='Show pre-release version.')
-def command_list(search, all=False, description=False, show_pre_release=False):
+@format_option
+def command_list(search, all=False, description=False, show_pre_release=False, output_format='table'):
     '''Search in firmware names and descriptions.'''
     fwlist = get_fwlist()
-    rows = fwlist.get_firmware_table(search, all=all, description=description, show_pre_release=show_pre_release)
-    if rows:
-        print_table([], rows)
-    else:
+    rows = fwlist.iter_firmware_table(search, all=all, description=description, show_pre_release=show_pre_release)
+    keys = ('firmware', 'description') if description else ('firmware',)
+    if not print_rows(keys, rows, output_format) and output_format == 'table':
         click.echo('Nothing found')
 
 
 @cli.command('update')
 def command_update():
     '''Update list of available firmware.'''
-    fwlist = get_fwlist()
+    fwlist = get_fwlist('never')
     fwlist.update()
 
 
@@ -388,10 +463,11 @@ def command_source_list():
 
 
 @source.command('add')
+@click.option('--type', 'type', type=click.Choice(['list', 'api', 'delta']), default='list', help='Source type, delta is the manifest of firmware_list_maker.py.', show_default=True)
 @click.argument('url', metavar="URL")
-def command_source_add(url):
+def command_source_add(url, type):
     '''Add firmware source.'''
-    get_fwlist().source_add(url)
+    get_fwlist().source_add(url, type)
     click.secho('OK', fg='green')
 
 
@@ -407,13 +483,23 @@ def command_source_remove(remove_from_list, url):
 @source.command('test')
 def command_source_test():
     '''Test firmware source.'''
-    for name in get_fwlist().source_get_list():
-        click.echo(name)
-        data = futils.load_source_from_url(name)
+    import bcf.firmware.utils as futils
+    checker = _get_url_checker()
+    sources = []
+
+    fwlist = get_fwlist()
+    for name in fwlist.source_get_list():
+        data = futils.load_source_from_url(name, fwlist.source_get_type(name))
         if data:
-            for fwdata in data['list']:
-                click.echo(fwdata['repository'])
-                futils.test_firmware_resources(fwdata)
+            sources.append((name, data['list'] if isinstance(data, dict) else data))
+
+    checker.check([url for name, fwdatas in sources for fwdata in fwdatas for url in futils.get_firmware_resource_urls(fwdata)])
+
+    for name, fwdatas in sources:
+        click.echo(name)
+        for fwdata in fwdatas:
+            click.echo(fwdata['repository'])
+            futils.test_firmware_resources(fwdata, checker=checker)
 
 
 @cli.command('test')
@@ -421,6 +507,7 @@ def command_source_test():
 @click.option('--skip-url', 'skip_url', is_flag=True, help='Skip testing the availability of urls.')
 def command_test(path, skip_url):
     '''Test firmware source.'''
+    import bcf.firmware.utils as futils
     meta_yml_filename = os.path.join(path, 'meta.yml')
 
     click.echo('Test %s' % meta_yml_filename)
@@ -431,7 +518,12 @@ def command_test(path, skip_url):
     click.echo("  - file is valid")
 
     if not skip_url:
-        futils.test_firmware_resources(meta_yaml)
+        futils.test_firmware_resources(meta_yaml, checker=_get_url_checker())
+
+
+def _get_url_checker():
+    from bcf import net
+    return net.UrlChecker(os.path.join(user_cache_dir, 'url_check.json'))
 
 
 @cli.command('ftdi')
@@ -442,6 +534,7 @@ def command_test(path, skip_url):
 @click.option('-r', '--reset', is_flag=True, help='Force USB device reset.')
 def command_ftdi(sn, manufacturer=None, product=None, serial=None, reset=False):
     '''Update USB descriptors in the FTDI chip.'''
+    from bcf import ftdi
 
     if manufacturer is not None or product is not None or serial is not None or reset:
         ftdi.update_eeprom(sn, manufacturer, product, serial, reset)
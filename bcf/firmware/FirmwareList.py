@@ -3,42 +3,130 @@ import os
 import sys
 import json
 import yaml
-import requests
 import hashlib
 import uuid
 import click
+import bisect
+import pickle
+import tempfile
+import time
+import subprocess
+import concurrent.futures
+import requests
 from .yml_schema import source_yml_schema
 from . import utils
+from . import search as fsearch
 
 DEFAULT_SOURCE_API = 'https://firmware.hardwario.com/tower/api/v1/list'
 
+LIST_CACHE_VERSION = 1
+
+# Refresh policy, what may happen when the list is needed:
+#   never      - only the cached list is used, missing list is empty
+#   missing    - missing list is downloaded synchronously
+#   background - as missing, and a list older than LIST_MAX_AGE is served
+#                while `bcf update` refreshes it in a background process
+REFRESH_NEVER = 'never'
+REFRESH_MISSING = 'missing'
+REFRESH_BACKGROUND = 'background'
+
+LIST_MAX_AGE = float(os.getenv('BCF_LIST_MAX_AGE_HOURS', '24')) * 3600
+OFFLINE = os.getenv('BCF_OFFLINE', '') not in ('', '0')
+
+# Minimal interval between background refreshes, also when one fails.
+REFRESH_INTERVAL = 600
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
 
 class FirmwareList:
 
-    def __init__(self, cache_dir, config_dir):
-        self._list = []
+    def __init__(self, cache_dir, config_dir, refresh=REFRESH_BACKGROUND):
+        self._list = None
         self._source = None
+        self._firmware_index = {}
+        self._version_index = {}
+        self._names = []
 
         self._cache_dir = cache_dir
         self._config_dir = config_dir
+        self._refresh = REFRESH_NEVER if OFFLINE else refresh
 
-        os.makedirs(self._cache_dir, exist_ok=True)
-        os.makedirs(self._config_dir, exist_ok=True)
+    def _load(self):
+        '''Load the list on first use, according to the refresh policy.'''
+        if self._list is not None:
+            return
 
         self._load_list_yml()
 
+        try:
+            mtime = os.path.getmtime(os.path.join(self._cache_dir, 'firmware_list.yml'))
+        except OSError:
+            if self._refresh != REFRESH_NEVER:
+                self.update()
+            return
+
+        # bcf update without changes leaves the yml untouched, only marks the check.
+        try:
+            mtime = max(mtime, os.path.getmtime(os.path.join(self._cache_dir, 'firmware_list.checked')))
+        except OSError:
+            pass
+
+        if self._refresh == REFRESH_BACKGROUND and LIST_MAX_AGE and time.time() - mtime > LIST_MAX_AGE:
+            self._refresh_background()
+
+    def _refresh_background(self):
+        '''Start detached `bcf update`, at most once per REFRESH_INTERVAL.'''
+        stamp = os.path.join(self._cache_dir, 'firmware_list.refresh')
+        try:
+            if time.time() - os.path.getmtime(stamp) < REFRESH_INTERVAL:
+                return
+        except OSError:
+            pass
+
+        try:
+            with open(stamp, 'w'):
+                pass
+
+            kwargs = {}
+            if os.name == 'nt':
+                kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS
+            else:
+                kwargs['start_new_session'] = True
+
+            subprocess.Popen([sys.executable, '-m', 'bcf', 'update'], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=True, **kwargs)
+        except Exception:
+            pass
+
     def firmware_iter(self):
+        self._load()
         for row in self._list:
             for fw in row['list']:
                 yield fw
 
+    def _build_index(self):
+        self._firmware_index = {}
+        self._version_index = {}
+        for firmware in self.firmware_iter():
+            name = firmware['name']
+            if name in self._firmware_index:
+                continue
+            self._firmware_index[name] = firmware
+            versions = firmware.get('versions') or []
+            for v in versions:
+                self._version_index.setdefault((name, v['name']), v)
+            if versions:
+                self._version_index[(name, 'latest')] = versions[0]
+
+        self._names = sorted(firmware['name'] for firmware in self.firmware_iter())
+
     def get_firmware(self, name):
+        self._load()
         index = name.find(':')
         if index > -1:
             name = name[:index]
-        for firmware in self.firmware_iter():
-            if name == firmware['name']:
-                return firmware
+        return self._firmware_index.get(name)
 
     def get_firmware_version(self, name):
         try:
@@ -46,93 +134,179 @@ class FirmwareList:
         except Exception as e:
             raise Exception("Bad firmware name")
 
-        for firmware in self.firmware_iter():
-            if name == firmware['name']:
-                if 'versions' not in firmware or not firmware['versions']:
-                    return
-
-                if version == 'latest':
-                    return firmware['versions'][0]
-
-                for v in firmware['versions']:
-                    if version == v['name']:
-                        return v
+        self._load()
+        return self._version_index.get((name, version))
 
     def get_firmware_list(self, startswith=None, add_latest=True):
+        self._load()
         suffix = ':latest' if add_latest else ''
         if startswith:
             array = []
-            for firmware in self.firmware_iter():
-                if firmware['name'].startswith(startswith):
-                    array.append(firmware['name'] + suffix)
+            for i in range(bisect.bisect_left(self._names, startswith), len(self._names)):
+                if not self._names[i].startswith(startswith):
+                    break
+                array.append(self._names[i] + suffix)
             return array
         else:
             return [firmware['name'] + suffix for firmware in self.firmware_iter()]
 
     def get_firmware_table(self, search='', all=False, description=False, show_pre_release=False):
-        table = []
-        for firmware in self.firmware_iter():
+        return list(self.iter_firmware_table(search, all, description, show_pre_release))
+
+    def iter_firmware_table(self, search='', all=False, description=False, show_pre_release=False):
+        '''Yield rows of name:version, search results are ranked by the search index.
+
+        The part of search after a colon filters versions. Search without colon
+        which matches no name, tag or description filters versions of all
+        firmware instead, so 'v1.2' finds the versions containing it.
+        '''
+        version_search = ''
+        if search:
+            query, colon, version_search = search.partition(':')
+            firmware_list = [self._firmware_index[name] for name in self._search_index().search(query)]
+            if not firmware_list and not colon:
+                version_search = search
+                firmware_list = self.firmware_iter()
+        else:
+            firmware_list = self.firmware_iter()
+
+        for firmware in firmware_list:
             if 'versions' not in firmware or not firmware['versions']:
                 continue
 
             for version in firmware['versions']:
-                n = firmware['name'] + ':' + version['name']
+                if version_search and version_search.lower() not in version['name'].lower():
+                    continue
 
-                row = [n]
+                row = [firmware['name'] + ':' + version['name']]
 
                 if description:
                     row.append(firmware['description'])
 
-                if search:
-                    if search in n or (firmware['description'] and search in firmware['description']):
-                        table.append(row)
-                else:
-                    table.append(row)
+                yield row
 
                 if not all:
                     break
 
-        return table
+    def _search_index(self):
+        '''Return the search index, loaded from firmware_list.search when it matches the list.'''
+        self._load()
+        try:
+            stamp = self._search_index_stamp(os.path.join(self._cache_dir, 'firmware_list.yml'))
+            with open(os.path.join(self._cache_dir, 'firmware_list.search'), 'rb') as fd:
+                cache = pickle.load(fd)
+            if cache['stamp'] == stamp:
+                return cache['index']
+        except Exception:
+            pass
+
+        return self._save_search_index()
 
-    def update(self):
+    def update(self, jobs=8):
+        '''Fetch all sources concurrently, revalidated by the ETag/Last-Modified stored per source.
+
+        The list is saved only when some source changed.
+        '''
+        self._load_list_yml()
         self._load_source_yml()
-        for source in self._source:
-            if source['type'] == 'list':
-                data = utils.load_source_from_url(source['url'])
-                if data:
-                    self._list_update(source, data)
-            elif source['type'] == 'api':
-                data = utils.load_source_from_url(source['url'])
-                if data:
-                    self._list_update(source, {'list': data})
 
-        self._save_list_yml()
+        rows = {row['source']['id']: row for row in self._list}
+
+        def fetch(source):
+            return self._fetch_source(source, rows.get(source['id']))
+
+        changed = False
+        failed = False
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(jobs, len(self._source)))) as executor:
+            futures = [(source, executor.submit(fetch, source)) for source in self._source]
+
+            for source, future in futures:
+                try:
+                    data, etag, last_modified = future.result()
+                except Exception as e:
+                    failed = True
+                    click.secho("Download list from %s    " % source['url'], nl=False, fg='red')
+                    if isinstance(e, requests.exceptions.ConnectionError):
+                        click.echo("Unable to connect to server")
+                    else:
+                        click.echo("Error " + str(e))
+                    continue
 
-    def _list_update(self, source, data):
+                if data is None:
+                    click.secho("List from %s is up to date" % source['url'], fg='green')
+                    continue
+
+                click.secho("Download list from %s    " % source['url'], fg='green')
+
+                self._list_update(source, data, etag, last_modified)
+                changed = True
+
+        if changed or not os.path.exists(os.path.join(self._cache_dir, 'firmware_list.yml')):
+            self._save_list_yml()
+
+        if not failed:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(os.path.join(self._cache_dir, 'firmware_list.checked'), 'w'):
+                pass
+
+    def _fetch_source(self, source, row=None):
+        '''Return (data, etag, last_modified) of source, data is None when it did not change since row.'''
+        validators = row['source'] if row else {}
+
+        if source['type'] == 'delta':
+            return utils.fetch_delta(source['url'], row['list'] if row else [], row.get('hashes') if row else None, validators.get('etag'), validators.get('last_modified'))
+
+        data, etag, last_modified = utils.fetch_source(source['url'], validators.get('etag'), validators.get('last_modified'))
+        if data is not None and source['type'] == 'api':
+            data = {'list': data}
+
+        return data, etag, last_modified
+
+    def _list_update(self, source, data, etag=None, last_modified=None):
+        self._load_list_yml()
         for row in self._list:
             if row['source']['id'] == source['id']:
+                row['source']['etag'] = etag
+                row['source']['last_modified'] = last_modified
                 row['list'] = data['list']
                 break
         else:
-            self._list.append({
+            row = {
                 'source': {
                     'id': source['id'],
                     'url': source['url'],
-                    'type': source['type']
+                    'type': source['type'],
+                    'etag': etag,
+                    'last_modified': last_modified
                 },
                 'list': data['list']
-            })
+            }
+            self._list.append(row)
+
+        if 'hashes' in data:
+            row['hashes'] = data['hashes']
+
+        self._build_index()
 
     def clear(self):
         self._list = []
-        filename = os.path.join(self._cache_dir, 'firmware_list.yml')
-        if os.path.exists(filename):
-            os.unlink(filename)
+        self._build_index()
+        for name in ('firmware_list.yml', 'firmware_list.cache', 'firmware_list.complete', 'firmware_list.checked', 'firmware_list.search'):
+            filename = os.path.join(self._cache_dir, name)
+            if os.path.exists(filename):
+                os.unlink(filename)
 
     def source_get_list(self):
         self._load_source_yml()
         return [source['url'] for source in self._source]
 
+    def source_get_type(self, url):
+        self._load_source_yml()
+        for source in self._source:
+            if source['url'] == url:
+                return source['type']
+
     def source_remove(self, url, remove_from_list=True):
         self._load_source_yml()
         for source in self._source:
@@ -142,25 +316,38 @@ class FirmwareList:
             raise Exception('This source not exists.')
 
         if remove_from_list:
+            self._load_list_yml()
             find_i = None
             for i, row in enumerate(self._list):
                 if row['source']['id'] == source['id']:
                     find_i = i
                     break
 
-            if find_i:
+            if find_i is not None:
                 del self._list[find_i]
+                self._build_index()
                 self._save_list_yml()
 
         self._source.remove(source)
         self._save_source_yml()
 
-    def source_add(self, url, type):
+    def source_add(self, url, type='list'):
         self._load_source_yml()
         for source in self._source:
             if source['url'] == url:
                 raise Exception('This source alredy exists.')
 
+        source = self._source_new(url, type)
+
+        data, etag, last_modified = self._fetch_source(source)
+
+        self._source.append(source)
+        self._save_source_yml()
+
+        self._list_update(source, data, etag, last_modified)
+        self._save_list_yml()
+
+    def _source_new(self, url, type):
         source = {
             'type': type,
             'url': url,
@@ -168,31 +355,91 @@ class FirmwareList:
 
         source['id'] = hashlib.sha1(json.dumps(source).encode()).hexdigest()
 
-        response = requests.get(url, allow_redirects=True)
-        data = yaml.safe_load(response.text)
-
-        self._source.append(source)
-        self._save_source_yml()
-
-        self._list_update(source, data)
-        self._save_list_yml()
+        return source
 
     def _load_list_yml(self):
+        '''Load the cached list, never touches network.'''
+        if self._list is not None:
+            return
+
         filename = os.path.join(self._cache_dir, 'firmware_list.yml')
 
+        self._list = []
         if os.path.exists(filename):
-            try:
-                with open(filename, 'r', encoding='utf-8') as fd:
-                    self._list = yaml.safe_load(fd)
-            except Exception as e:
-                raise Exception('Error load source yml ' + str(e))
-        else:
-            self.update()
+            self._list = self._load_list_cache(filename)
+            if self._list is None:
+                try:
+                    with open(filename, 'r', encoding='utf-8') as fd:
+                        self._list = yaml.load(fd, Loader=YamlLoader) or []
+                except Exception as e:
+                    raise Exception('Error load source yml ' + str(e))
+                self._save_list_cache(filename)
+                self._save_complete_index()
+
+        self._build_index()
 
     def _save_list_yml(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
         filename = os.path.join(self._cache_dir, 'firmware_list.yml')
-        with open(filename, 'w', encoding='utf-8') as fd:
-            yaml.safe_dump(self._list, fd, indent=2, default_flow_style=False)
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            yaml.dump(self._list, f, Dumper=YamlDumper, indent=2, default_flow_style=False)
+        os.replace(tmp, filename)
+        self._save_list_cache(filename)
+        self._save_complete_index()
+        self._save_search_index()
+
+    def _list_cache_stamp(self, filename):
+        stat = os.stat(filename)
+        return [LIST_CACHE_VERSION, stat.st_mtime_ns, stat.st_size]
+
+    def _load_list_cache(self, filename):
+        '''Return the list from the pickled cache, None when it is missing or older than the yml.'''
+        try:
+            with open(os.path.join(self._cache_dir, 'firmware_list.cache'), 'rb') as fd:
+                cache = pickle.load(fd)
+            if cache['stamp'] == self._list_cache_stamp(filename):
+                return cache['list']
+        except Exception:
+            pass
+
+    def _save_list_cache(self, filename):
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump({'stamp': self._list_cache_stamp(filename), 'list': self._list}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, os.path.join(self._cache_dir, 'firmware_list.cache'))
+
+    def _search_index_stamp(self, filename):
+        return self._list_cache_stamp(filename) + [fsearch.SEARCH_INDEX_VERSION]
+
+    def _save_search_index(self):
+        '''Build the search index and store it next to the list cache, when there is a list file.'''
+        index = fsearch.SearchIndex(self._firmware_index.values())
+
+        filename = os.path.join(self._cache_dir, 'firmware_list.yml')
+        if os.path.exists(filename):
+            fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'stamp': self._search_index_stamp(filename), 'index': index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, os.path.join(self._cache_dir, 'firmware_list.search'))
+
+        return index
+
+    def _save_complete_index(self):
+        '''Write sorted lines of name, name:latest and name:version for shell completion, see bcf.utils.complete_firmware.'''
+        items = set()
+        for firmware in self.firmware_iter():
+            items.add(firmware['name'])
+            versions = firmware.get('versions') or []
+            if versions:
+                items.add(firmware['name'] + ':latest')
+            for version in versions:
+                items.add(firmware['name'] + ':' + version['name'])
+
+        fd, tmp = tempfile.mkstemp(dir=self._cache_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(sorted(items)))
+        os.replace(tmp, os.path.join(self._cache_dir, 'firmware_list.complete'))
 
     def _load_source_yml(self):
         if self._source is not None:
@@ -204,7 +451,6 @@ class FirmwareList:
                 with open(filename, 'r', encoding='utf-8') as fd:
                     source_yml = yaml.safe_load(fd)
                     self._source = source_yml_schema.validate(source_yml)
-                    print(self._source)
                     for source in self._source:
                         if source['url'] == 'https://firmware.bigclown.com/json':
                             source['url'] = DEFAULT_SOURCE_API
@@ -212,8 +458,8 @@ class FirmwareList:
                             self.clear()
                             self._save_source_yml()
             else:
-                self._source = []
-                return self.source_add(DEFAULT_SOURCE_API, 'api')
+                self._source = [self._source_new(DEFAULT_SOURCE_API, 'api')]
+                self._save_source_yml()
 
         except Exception as e:
             raise Exception('Error load source yml ' + str(e))
@@ -221,6 +467,7 @@ class FirmwareList:
     def _save_source_yml(self):
         if self._source is None:
             return
+        os.makedirs(self._config_dir, exist_ok=True)
         filename = os.path.join(self._config_dir, 'source.yml')
         with open(filename, 'w', encoding='utf-8') as fd:
             yaml.safe_dump(self._source, fd, indent=2, default_flow_style=False)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import bisect
+
+SEARCH_INDEX_VERSION = 1
+
+# Weight of a match in the field of firmware.
+FIELDS = (('name', 4), ('tags', 2), ('description', 1))
+
+# Quality of a token match, multiplies the field weight.
+EXACT = 3
+PREFIX = 2
+INSIDE = 1
+
+_split = re.compile(r'[^0-9a-z]+').split
+
+
+def tokenize(text):
+    return [token for token in _split(text.lower()) if token]
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class SearchIndex(object):
+    '''Ranked case-insensitive search in names, tags and descriptions of firmware.
+
+    Every distinct token is indexed by its trigrams, so a query term matches
+    the tokens containing it; terms shorter than three characters match
+    token prefixes. All terms of the query have to match.
+    '''
+
+    def __init__(self, firmware_list):
+        self.names = []
+        self.postings = {}
+
+        for firmware in firmware_list:
+            doc = len(self.names)
+            self.names.append(firmware['name'])
+            for field, weight in FIELDS:
+                value = firmware.get(field) or ''
+                if isinstance(value, list):
+                    value = ' '.join(value)
+                for token in tokenize(value):
+                    postings = self.postings.setdefault(token, {})
+                    postings[doc] = max(postings.get(doc, 0), weight)
+
+        self.vocabulary = sorted(self.postings)
+        self.trigrams = {}
+        for i, token in enumerate(self.vocabulary):
+            for trigram in trigrams(token):
+                self.trigrams.setdefault(trigram, []).append(i)
+
+    def _tokens(self, term):
+        '''Yield (token, quality) of the tokens containing term.'''
+        if len(term) < 3:
+            for i in range(bisect.bisect_left(self.vocabulary, term), len(self.vocabulary)):
+                token = self.vocabulary[i]
+                if not token.startswith(term):
+                    break
+                yield token, EXACT if token == term else PREFIX
+            return
+
+        candidates = None
+        for trigram in trigrams(term):
+            found = self.trigrams.get(trigram)
+            if not found:
+                return
+            candidates = set(found) if candidates is None else candidates.intersection(found)
+
+        for i in candidates:
+            token = self.vocabulary[i]
+            if term in token:
+                yield token, EXACT if token == term else PREFIX if token.startswith(term) else INSIDE
+
+    def search(self, query):
+        '''Return names of firmware matching query, the best match first.'''
+        scores = None
+
+        for term in tokenize(query):
+            term_scores = {}
+            for token, quality in self._tokens(term):
+                for doc, weight in self.postings[token].items():
+                    term_scores[doc] = max(term_scores.get(doc, 0), weight * quality)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc: score + term_scores[doc] for doc, score in scores.items() if doc in term_scores}
+
+        if scores is None:
+            return list(self.names)
+
+        return [self.names[doc] for doc in sorted(scores, key=lambda doc: (-scores[doc], doc))]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import random
+
+    # Benchmark: python3 bcf/firmware/search.py [number of firmware]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    words = ['radio', 'push', 'button', 'climate', 'monitor', 'lora', 'nbiot', 'sigfox', 'gateway', 'dongle', 'co2', 'sensor', 'motion', 'detector', 'relay', 'lcd', 'thermostat', 'soil', 'flood']
+    random.seed(1)
+    firmware_list = [{
+        'name': 'owner%d/twr-%s-%d' % (i % 20, '-'.join(random.sample(words, 2)), i),
+        'description': ' '.join(random.sample(words, 6)),
+        'tags': random.sample(words, 3),
+        'versions': [{'name': 'v1.%d.0' % j} for j in range(10)]
+    } for i in range(count)]
+
+    query = 'Radio Button'
+
+    t = time.perf_counter()
+    for firmware in firmware_list:
+        for version in firmware['versions']:
+            n = firmware['name'] + ':' + version['name']
+            query in n or query in firmware['description']
+    print('substring       %8.1f ms' % ((time.perf_counter() - t) * 1000))
+
+    t = time.perf_counter()
+    index = SearchIndex(firmware_list)
+    print('build index     %8.1f ms' % ((time.perf_counter() - t) * 1000))
+
+    t = time.perf_counter()
+    result = index.search(query)
+    print('index search    %8.1f ms, %d results' % ((time.perf_counter() - t) * 1000, len(result)))
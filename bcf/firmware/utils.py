@@ -1,8 +1,16 @@
+import os
+import json
+import hashlib
+import concurrent.futures
+from urllib.parse import urljoin
 import yaml
 import schema
 import requests
 import click
-from bcf.firmware.yml_schema import meta_yml_schema, validate
+from bcf import net
+from bcf.firmware.yml_schema import meta_yml_schema, manifest_yml_schema, validate
+
+DELTA_VERSION = 1
 
 
 def load_meta_yaml(fd):
@@ -11,16 +19,56 @@ def load_meta_yaml(fd):
     return meta_yaml
 
 
-def load_source_from_url(url):
+def load_manifest(filename):
+    '''Load flash manifest (YAML or JSON), paths are relative to the manifest.
+
+    Returns the manifest with eeprom converted to a list of (address, data).
+    '''
+    with open(filename, 'r', encoding='utf-8') as fd:
+        manifest = yaml.safe_load(fd)
+
+    validate(manifest_yml_schema, manifest)
+
+    base_dir = os.path.dirname(os.path.abspath(filename))
+
+    firmware = manifest.get('firmware')
+    if firmware and not firmware.startswith('http'):
+        path = os.path.join(base_dir, firmware)
+        if os.path.isfile(path):
+            manifest['firmware'] = path
+
+    eeprom = []
+    for item in manifest.get('eeprom', []):
+        address = item.get('address', 0)
+        if 'file' in item:
+            with open(os.path.join(base_dir, item['file']), 'rb') as f:
+                data = f.read()
+        else:
+            try:
+                data = bytes.fromhex(item['data'])
+            except ValueError:
+                raise Exception('Bad hex data in manifest at address %d' % address)
+        if address + len(data) > 6144:
+            raise Exception('Manifest EEPROM data at address %d does not fit into EEPROM' % address)
+        eeprom.append((address, data))
+    manifest['eeprom'] = eeprom
+
+    return manifest
+
+
+def load_source_from_url(url, type='list'):
     click.echo("Download list from %s ..." % url, nl=False)
 
     try:
-        response = requests.get(url, allow_redirects=True)
+        if type == 'delta':
+            data = fetch_delta(url, [], None)[0]
+        else:
+            response = net.get(url)
 
-        if response.status_code < 200 or response.status_code >= 300:
-            raise Exception("Response status_code=%d" % response.status_code)
+            if response.status_code < 200 or response.status_code >= 300:
+                raise Exception("Response status_code=%d" % response.status_code)
 
-        data = yaml.safe_load(response.text)
+            data = yaml.safe_load(response.text)
 
         click.secho("\r\rDownload list from %s    " % url, fg='green')
 
@@ -34,44 +82,120 @@ def load_source_from_url(url):
             click.echo("Error " + str(e))
 
 
-def test_firmware_resources(data, skip_error=True):
+def fetch_source(url, etag=None, last_modified=None):
+    '''Download the source document unless it is unchanged since etag/last_modified.
 
-    error_url = []
+    Returns (data, etag, last_modified), data is None when the server answers
+    304 Not Modified.
+    '''
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    response = net.get(url, headers=headers)
+
+    if response.status_code == 304:
+        return None, etag, last_modified
+
+    if response.status_code < 200 or response.status_code >= 300:
+        raise Exception("Response status_code=%d" % response.status_code)
+
+    if 'json' in response.headers.get('Content-Type', ''):
+        data = response.json()
+    else:
+        data = yaml.load(response.text, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    return data, response.headers.get('ETag'), response.headers.get('Last-Modified')
 
-    def test_url(url):
-        text = '  - url: %s ... ' % url
-        click.echo(text, nl=False)
-        response = requests.head(url, allow_redirects=True)
-        if response.status_code != 204 and response.status_code != 200:
-            if skip_error:
-                click.secho('error', fg='red')
-                error_url.append(url)
-            else:
-                click.echo()
-                raise Exception('Bad status code %s' % response.status_code)
-        else:
-            click.secho('ok', fg='green')
+
+def fetch_delta(url, current, hashes, etag=None, last_modified=None, jobs=8):
+    '''Fetch the delta manifest and only the shards which changed against hashes.
+
+    The manifest published by firmware_list_maker.py lists {'name', 'sha256',
+    'shard'} of every firmware in order, shard is relative to the manifest url.
+    current is the list from the previous update and hashes its {name: sha256}.
+    Returns (data, etag, last_modified) like fetch_source, data is
+    {'list': [...], 'hashes': {name: sha256}}.
+    '''
+    manifest, etag, last_modified = fetch_source(url, etag, last_modified)
+    if manifest is None:
+        return None, etag, last_modified
+
+    if manifest.get('version') != DELTA_VERSION:
+        raise Exception('Unsupported delta manifest version %s' % manifest.get('version'))
+
+    hashes = hashes or {}
+    firmware = {fw['name']: fw for fw in current}
+    changed = [item for item in manifest['firmware'] if hashes.get(item['name']) != item['sha256'] or item['name'] not in firmware]
+
+    def fetch_shard(item):
+        response = net.get(urljoin(url, item['shard']))
+        if response.status_code < 200 or response.status_code >= 300:
+            raise Exception("Response status_code=%d for %s" % (response.status_code, item['shard']))
+        if hashlib.sha256(response.content).hexdigest() != item['sha256']:
+            raise Exception('Bad hash of shard %s' % item['shard'])
+        return json.loads(response.content.decode('utf-8'))
+
+    if changed:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(jobs, len(changed))) as executor:
+            for item, fw in zip(changed, executor.map(fetch_shard, changed)):
+                firmware[item['name']] = fw
+
+    data = {
+        'list': [firmware[item['name']] for item in manifest['firmware']],
+        'hashes': {item['name']: item['sha256'] for item in manifest['firmware']}
+    }
+
+    return data, etag, last_modified
+
+
+def get_firmware_resource_urls(data):
+    urls = []
 
     if 'article' in data:
-        test_url(data['article'])
+        urls.append(data['article'])
     if 'video' in data:
-        test_url(data['video'])
+        urls.append(data['video'])
     if 'articles' in data:
         for article in data['articles']:
-            test_url(article['url'])
+            urls.append(article['url'])
             if 'video' in article:
-                test_url(article['video'])
+                urls.append(article['video'])
             if 'images' in article:
                 for image in article['images']:
-                    test_url(image['url'])
+                    urls.append(image['url'])
     if 'images' in data:
         for image in data['images']:
-            test_url(image['url'])
+            urls.append(image['url'])
     if 'assembly' in data:
         for assembly in data['assembly']:
             if 'url' in assembly:
-                test_url(assembly['url'])
+                urls.append(assembly['url'])
             if 'image' in assembly:
-                test_url(assembly['image'])
+                urls.append(assembly['image'])
+
+    return urls
+
+
+def test_firmware_resources(data, skip_error=True, checker=None):
+    if checker is None:
+        checker = net.UrlChecker()
+
+    error_url = []
+
+    urls = get_firmware_resource_urls(data)
+
+    for url, status in checker.check(urls).items():
+        click.echo('  - url: %s ... ' % url, nl=False)
+        if net.is_ok(status):
+            click.secho('ok', fg='green')
+        elif skip_error:
+            click.secho('error', fg='red')
+            error_url.append(url)
+        else:
+            click.echo()
+            raise Exception('Bad status code %s' % status)
 
     return error_url
@@ -40,12 +40,33 @@ source_yml_schema = Schema(
     [
         {
             'id': And(str, len),
-            'type': And(str, lambda x: x in ('list', 'api',)),
+            'type': And(str, lambda x: x in ('list', 'api', 'delta')),
             'url': And(str, len)
         }
     ]
 )
 
+manifest_yml_schema = Schema({
+    Optional('firmware'): And(str, len),
+    Optional('eeprom'): [
+        Or(
+            {
+                'file': And(str, len),
+                Optional('address'): And(int, lambda x: 0 <= x < 6144),
+            },
+            {
+                'data': And(str, len),
+                'address': And(int, lambda x: 0 <= x < 6144),
+            }
+        )
+    ],
+    Optional('erase_eeprom'): bool,
+    Optional('unprotect'): bool,
+    Optional('skip_verify'): bool,
+    Optional('diff'): bool,
+    Optional('baudrate'): int,
+})
+
 
 def validate(schema, data):
     try:
@@ -2,17 +2,26 @@
 # -*- coding: utf-8 -*-
 from . import uart
 from . import dfu
+from .uart import Flasher
+from . import image
 
 
-def flash(filename, device=None, reporthook=None, run=True, erase_eeprom=False, unprotect=False, skip_verify=False, diff=False, baudrate=921600):
+def flash(filename, device=None, reporthook=None, run=True, erase_eeprom=False, unprotect=False, skip_verify=False, diff=False, baudrate=921600, eeprom=None, cache_dir=None):
     if device == 'dfu':
-        if filename.endswith(".hex"):
+        if eeprom:
+            raise Exception("DFU not support EEPROM write.")
+        if filename is None:
+            raise Exception("DFU needs firmware to flash.")
+        fmt = image.file_format(filename)
+        if fmt == 'hex':
             raise Exception("DFU not support hex.")
+        if fmt == 'elf':
+            raise Exception("DFU not support elf.")
         if unprotect:
             raise Exception("DFU not support Unprotect.")
         dfu.flash(filename, reporthook=reporthook, erase_eeprom=erase_eeprom)
     else:
-        uart.flash(device, filename, run=run, reporthook=reporthook, erase_eeprom=erase_eeprom, unprotect=unprotect, skip_verify=skip_verify, diff=diff, baudrate=baudrate)
+        uart.flash(device, filename, run=run, reporthook=reporthook, erase_eeprom=erase_eeprom, unprotect=unprotect, skip_verify=skip_verify, diff=diff, baudrate=baudrate, eeprom=eeprom, cache_dir=cache_dir)
 
 
 def reset(device):
@@ -30,7 +39,7 @@ def eeprom_read(device, filename, address=0, length=6144, reporthook=None):
     if 0 > address or address >= 6144:
         raise Exception('Bad address')
 
-    if 0 >= length or length > 6144:
+    if 0 >= length or address + length > 6144:
         raise Exception('Bad length')
 
     if device == 'dfu':
@@ -43,10 +52,21 @@ def eeprom_write(device, filename, address=0, length=6144, reporthook=None):
     if 0 > address or address >= 6144:
         raise Exception('Bad address, max: 6144')
 
-    if 0 >= length or length > 6144:
+    if 0 >= length or address + length > 6144:
         raise Exception('Bad length, max: 6144')
 
     if device == 'dfu':
         raise Exception('Not implemented.')
     else:
         uart.eeprom_write(device, filename, address, length, reporthook=reporthook)
+
+
+def eeprom_patch(device, patches, reporthook=None):
+    for address, data in patches:
+        if 0 > address or address + len(data) > 6144:
+            raise Exception('Bad patch address %d, max: 6144' % address)
+
+    if device == 'dfu':
+        raise Exception('Not implemented.')
+    else:
+        uart.eeprom_patch(device, patches, reporthook=reporthook)
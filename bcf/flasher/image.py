@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import io
+import re
+import pickle
+import hashlib
+import struct
+import tempfile
+
+FLASH_START = 0x08000000
+FLASH_END = 0x08030000
+EEPROM_START = 0x08080000
+EEPROM_END = 0x08081800
+PAGE_SIZE = 128
+
+IMAGE_CACHE_VERSION = 1
+
+PT_LOAD = 1
+
+# Start of an Intel HEX record: colon, byte count, address and record type.
+_HEX_RECORD = re.compile(br':[0-9A-Fa-f]{8}')
+
+
+class Image(object):
+    '''Sparse memory image, sorted segments of (address, data).'''
+
+    def __init__(self, segments):
+        self.segments = []
+        for address, data in sorted(segments):
+            if not data:
+                continue
+            stop = address + len(data)
+            if not (FLASH_START <= address and stop <= FLASH_END) and not (EEPROM_START <= address and stop <= EEPROM_END):
+                raise Exception("Unknown memory address 0x%08x" % address)
+            if self.segments and self.segments[-1][0] + len(self.segments[-1][1]) == address:
+                self.segments[-1] = (self.segments[-1][0], self.segments[-1][1] + bytes(data))
+            else:
+                self.segments.append((address, bytes(data)))
+
+    @classmethod
+    def from_bin(cls, data, address=FLASH_START):
+        return cls([(address, data)])
+
+    @classmethod
+    def from_hex(cls, data):
+        import intelhex
+        ih = intelhex.IntelHex(io.StringIO(data.decode('ascii')))
+        return cls([(start, ih.tobinstr(start=start, end=stop - 1)) for start, stop in ih.segments()])
+
+    @classmethod
+    def from_elf(cls, data):
+        '''Load the PT_LOAD segments of 32-bit little-endian ELF at their physical (load) address.'''
+        if data[:4] != b'\x7fELF' or data[4] != 1 or data[5] != 1:
+            raise Exception('Only 32-bit little-endian ELF is supported.')
+
+        e_phoff, = struct.unpack_from('<I', data, 28)
+        e_phentsize, e_phnum = struct.unpack_from('<HH', data, 42)
+
+        segments = []
+        for i in range(e_phnum):
+            p_type, p_offset, p_vaddr, p_paddr, p_filesz = struct.unpack_from('<5I', data, e_phoff + i * e_phentsize)
+            if p_type == PT_LOAD and p_filesz:
+                segments.append((p_paddr, data[p_offset:p_offset + p_filesz]))
+
+        return cls(segments)
+
+    @property
+    def length(self):
+        return sum(len(data) for address, data in self.segments)
+
+    def flash_pages(self):
+        '''Return sorted numbers of the flash pages covered by the image.'''
+        pages = set()
+        for address, data in self.segments:
+            if address < FLASH_END:
+                first = (address - FLASH_START) // PAGE_SIZE
+                last = (address + len(data) - 1 - FLASH_START) // PAGE_SIZE
+                pages.update(range(first, last + 1))
+        return sorted(pages)
+
+    def page(self, number):
+        '''Return expected content of the flash page after flashing, erased bytes are 0xFF.'''
+        start = FLASH_START + number * PAGE_SIZE
+        stop = start + PAGE_SIZE
+        page = bytearray(b'\xff' * PAGE_SIZE)
+        for address, data in self.segments:
+            if address < stop and address + len(data) > start:
+                a = max(address, start)
+                b = min(address + len(data), stop)
+                page[a - start:b - start] = data[a - address:b - address]
+        return bytes(page)
+
+    def chunks(self, step=PAGE_SIZE):
+        for address, data in self.segments:
+            for offset in range(0, len(data), step):
+                yield address + offset, data[offset:offset + step]
+
+
+def file_format(filename, content=None):
+    '''Return 'elf', 'hex' or 'bin' by the extension or the content of the file.
+
+    The content matters for files without extension, like the downloads in the cache.
+    '''
+    if content is None:
+        with open(filename, 'rb') as f:
+            content = f.read(16)
+
+    if filename.endswith('.elf') or content[:4] == b'\x7fELF':
+        return 'elf'
+    if filename.endswith('.hex') or _HEX_RECORD.match(content):
+        return 'hex'
+    return 'bin'
+
+
+def load(filename, cache_dir=None):
+    '''Load .bin (flat from 0x08000000), .hex or .elf file as Image.
+
+    Parsed hex files are cached in cache_dir by the hash of the file content.
+    '''
+    with open(filename, 'rb') as f:
+        content = f.read()
+
+    fmt = file_format(filename, content)
+
+    if fmt == 'elf':
+        return Image.from_elf(content)
+
+    if fmt == 'bin':
+        return Image.from_bin(content)
+
+    cache_file = None
+
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'images', hashlib.sha256(content).hexdigest())
+        try:
+            with open(cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['version'] == IMAGE_CACHE_VERSION:
+                os.utime(cache_file)  # last use for Cache.evict
+                return Image(cache['segments'])
+        except Exception:
+            pass
+
+    image = Image.from_hex(content)
+
+    if cache_file:
+        _save_cache(cache_file, {'version': IMAGE_CACHE_VERSION, 'segments': image.segments})
+
+    return image
+
+
+def _save_cache(filename, data):
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+    except Exception:
+        os.unlink(tmp)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import intelhex
+
+    # Benchmark: python3 bcf/flasher/image.py firmware.hex
+    filename = sys.argv[1]
+    cache_dir = tempfile.mkdtemp()
+
+    t = time.perf_counter()
+    ih = intelhex.IntelHex(filename)
+    for i in range(2):  # write and verify pass
+        for s in ih.segments():
+            sih = ih[s[0]:s[1]]
+            for address_start in range(s[0], s[1], PAGE_SIZE):
+                sih[address_start:min(address_start + PAGE_SIZE, s[1])].tobinstr()
+    print('intelhex        %8.1f ms' % ((time.perf_counter() - t) * 1000))
+
+    for label in ('image (cold)', 'image (cached)'):
+        t = time.perf_counter()
+        image = load(filename, cache_dir)
+        for i in range(2):
+            for chunk in image.chunks():
+                pass
+        print('%-15s %8.1f ms' % (label, (time.perf_counter() - t) * 1000))
@@ -51,6 +51,10 @@ class SerialPort:
         self.flush = self.ser.flush
         self.readline = self.ser.readline
 
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
     def close(self):
         if not self.ser:
             return
@@ -9,9 +9,8 @@ import serial.tools.list_ports
 from time import sleep, time
 import math
 import array
-import intelhex
-from ctypes import *
 from .serialport import ftdi
+from . import image as fimage
 try:
     import fcntl
     from .serialport import bridge
@@ -50,6 +49,12 @@ class Flash_Serial(object):
     def set_disconnect(self):
         self._connect = False
 
+    def close(self):
+        self._connect = False
+        close = getattr(self.ser, 'close', None)
+        if close:
+            close()
+
     def reconnect(self):
         self._connect = False
         return self.connect()
@@ -177,7 +182,7 @@ class Flash_Serial(object):
 
         mod = len(data) % 4
         if mod != 0:
-            data += bytearray([0] * mod)
+            data = bytes(data) + bytes([0xff] * (4 - mod))
 
         sa = self._int_to_bytes(start_address)
         xor = self._calculate_xor(sa)
@@ -360,13 +365,15 @@ def verify(device, firmware, reporthook=None, api=None, start_address=0x08000000
             reporthook(label, offset + read_len, length)
 
 
-def clone(device, filename, length, reporthook=None, api=None, start_address=0x08000000, label='Clone'):
+def read(device, length, reporthook=None, api=None, start_address=0x08000000, label='Read', step=128):
     if api is None:
         api = Flash_Serial(device)
         _run_connect(api)
 
-    f = open(filename, 'wb')
-    step = 128
+    if reporthook:
+        reporthook(label, 0, length)
+
+    buffer = bytearray()
     for offset in range(0, length, step):
         read_len = length - offset
         if read_len > step:
@@ -375,8 +382,8 @@ def clone(device, filename, length, reporthook=None, api=None, start_address=0x0
         for i in range(2):
             data = _try_run(api, 6, api.read_memory, start_address + offset, read_len)
             verify = _try_run(api, 6, api.read_memory, start_address + offset, read_len)
-            if data == verify:
-                f.write(data)
+            if data and data == verify:
+                buffer += data
                 break
         else:
             raise Exception(label + ' Error')
@@ -384,7 +391,90 @@ def clone(device, filename, length, reporthook=None, api=None, start_address=0x0
         if reporthook:
             reporthook(label, offset + read_len, length)
 
-    f.close()
+    return bytes(buffer)
+
+
+def clone(device, filename, length=None, reporthook=None, api=None, start_address=0x08000000, label='Clone'):
+    if api is None:
+        api = Flash_Serial(device)
+        _run_connect(api)
+
+    if length is None:
+        length = find_end(device, api=api, start_address=start_address)
+
+    data = read(device, length, reporthook=reporthook, api=api, start_address=start_address, label=label) if length else b''
+
+    if filename.endswith(".hex"):
+        import intelhex
+        ih = intelhex.IntelHex()
+        step = 256
+        for offset in range(0, length, step):
+            chunk = data[offset:offset + step]
+            if chunk != b'\xff' * len(chunk):
+                ih.puts(start_address + offset, chunk)
+        ih.write_hex_file(filename)
+    else:
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+
+def get_flash_size(device, api=None):
+    '''Return flash size in bytes from the FLASH_SIZE register or None.'''
+    if api is None:
+        api = Flash_Serial(device)
+        _run_connect(api)
+
+    data = _try_run(api, 2, api.read_memory, 0x1FF8007C, 2)
+    if not data or len(data) != 2:
+        return None
+
+    return int.from_bytes(data, 'little') * 1024
+
+
+def find_end(device, length=None, api=None, start_address=0x08000000, page_size=256, sample_step=8):
+    '''Return length of the programmed data, found by binary search for blank pages.
+
+    A page counts as blank only when the next page is blank too, so a single
+    padding page inside the image does not end the search. Past the found end
+    every sample_step-th page is read up to length and the search continues
+    behind a programmed one, data after a blank gap shorter than sample_step
+    pages can still be missed.
+    '''
+    if api is None:
+        api = Flash_Serial(device)
+        _run_connect(api)
+
+    if length is None:
+        length = min(get_flash_size(device, api) or 196608, 196608)
+
+    pages = int(math.ceil(length / page_size))
+
+    def is_blank_page(page):
+        data = _try_run(api, 6, api.read_memory, start_address + page * page_size, page_size)
+        if not data:
+            raise Exception('Read Error')
+        return data == b'\xff' * page_size
+
+    def is_blank(page):
+        return all(is_blank_page(p) for p in (page, page + 1) if p < pages)
+
+    low = 0
+    while True:
+        high = pages
+        while low < high:
+            middle = (low + high) // 2
+            if is_blank(middle):
+                high = middle
+            else:
+                low = middle + 1
+
+        first = (low // sample_step + 1) * sample_step
+        for page in range(first, pages, sample_step):
+            if not is_blank_page(page):
+                low = page + 1
+                break
+        else:
+            return min(low * page_size, length)
 
 
 def _unprotect(device, api=None):
@@ -405,135 +495,71 @@ def _unprotect(device, api=None):
     api.reconnect()
 
 
-def _flash_bin_diff(device, filename, reporthook, api, start_address=0x08000000):
-    firmware = open(filename, 'rb').read()
-
-    length = len(firmware)
-
-    page_size = 128
-
-    pages = int(math.ceil(length / page_size))
-    if pages > 1536:
-        pages = 1536
-
-    offset = 0
+def _flash_image_diff(device, image, reporthook, api):
+    pages = image.flash_pages()
 
     diff_pages = []
 
-    for page in range(0, pages):
-        read_len = length - offset
-        if read_len > page_size:
-            read_len = page_size
-
-        data = _try_run(api, 6, api.read_memory, start_address + offset, read_len)
+    for i, page in enumerate(pages):
+        data = _try_run(api, 6, api.read_memory, fimage.FLASH_START + page * fimage.PAGE_SIZE, fimage.PAGE_SIZE)
 
-        if data != firmware[offset:offset + read_len]:
+        if data != image.page(page):
             diff_pages.append(page)
 
         if reporthook:
-            reporthook('Compare', page + 1, pages)
-
-        offset += page_size
+            reporthook('Compare', i + 1, len(pages))
 
     if diff_pages:
-        print('Diff pages', len(diff_pages), 'of', pages)
+        print('Diff pages', len(diff_pages), 'of', len(pages))
         for i in range(0, len(diff_pages), 80):
             if _try_run(api, 6, api.extended_erase_memory, diff_pages[i:i + 80]):
                 if reporthook:
-                    reporthook('Erase diff pages', i + 80, len(diff_pages))
+                    reporthook('Erase diff pages', min(i + 80, len(diff_pages)), len(diff_pages))
             else:
                 raise Exception('Errase error')
 
         for i, page in enumerate(diff_pages):
-            offset = page * page_size
-            data = firmware[offset:offset + page_size]
-            if data:
-                if _try_run(api, 6, api.write_memory, start_address + offset, data):
-                    if reporthook:
-                        reporthook('Write diff pages', i + 1, len(diff_pages))
-                else:
-                    raise Exception('Write error')
-
-
-def _flash_bin(device, filename, reporthook, api, skip_verify):
-    firmware = open(filename, 'rb').read()
-
-    erase(device, length=len(firmware), reporthook=reporthook, api=api)
-
-    write(device, firmware, reporthook=reporthook, api=api)
-
-    if skip_verify:
-        return
-
-    verify(device, firmware, reporthook=reporthook, api=api)
-
+            if _try_run(api, 6, api.write_memory, fimage.FLASH_START + page * fimage.PAGE_SIZE, image.page(page)):
+                if reporthook:
+                    reporthook('Write diff pages', i + 1, len(diff_pages))
+            else:
+                raise Exception('Write error')
 
-def _flash_hex(device, filename, reporthook, api, skip_verify):
-    ih = intelhex.IntelHex(filename)
+    for address, data in image.chunks():
+        if address >= fimage.EEPROM_START and not _try_run(api, 6, api.write_memory, address, data):
+            raise Exception('Write error')
 
-    flash_address_start = 0x08000000
-    flash_address_end = 0x0802FFFF
-    eeprom_address_start = 0x08080000
-    eeprom_address_end = 0x080817FF
 
-    length = 0
-    pages = 0
+def _flash_image(device, image, reporthook, api, skip_verify):
+    length = image.length
+    if not length:
+        raise Exception('Nothing to flash, the image is empty.')
 
-    segments = ih.segments()
-    for s in segments:
-        slength = s[1] - s[0]
-        if flash_address_start <= s[0] <= flash_address_end:
-            length += slength
-            pages += int(math.ceil(slength / 128)) + 1
-        elif eeprom_address_start <= s[0] <= eeprom_address_end:
-            length += slength
-        else:
-            raise Exception("Unknown memory address %d", s[0])
+    pages = image.flash_pages()
 
-    if pages > 0:
+    if pages:
         if reporthook:
-            reporthook('Erase ', 0, pages)
+            reporthook('Erase ', 0, len(pages))
 
-        done = 0
-
-        for s in segments:
-            if flash_address_start <= s[0] <= flash_address_end:
-                page_start = int(math.floor((s[0] - flash_address_start) / 128))
-                s_pages = int(math.ceil((s[1] - s[0]) / 128)) + 1
-
-                for page_start in range(0, s_pages, 80):
-                    page_stop = page_start + 80
-                    if page_stop > s_pages:
-                        page_stop = s_pages
-
-                    if _try_run(api, 6, api.extended_erase_memory, range(page_start, page_stop)):
-                        if reporthook:
-                            reporthook('Erase ', done + page_stop, pages)
-                    else:
-                        raise Exception('Errase Error')
-
-                done += s_pages
+        for i in range(0, len(pages), 80):
+            if _try_run(api, 6, api.extended_erase_memory, pages[i:i + 80]):
+                if reporthook:
+                    reporthook('Erase ', min(i + 80, len(pages)), len(pages))
+            else:
+                raise Exception('Errase Error')
 
     if reporthook:
         reporthook('Write ', 0, length)
 
     done = 0
 
-    for s in segments:
-        sih = ih[s[0]:s[1]]
-        for address_start in range(s[0], s[1], 128):
-            address_stop = address_start + 128
-            if address_stop > s[1]:
-                address_stop = s[1]
-
-            data = sih[address_start:address_stop].tobinstr()
-
-            if _try_run(api, 6, api.write_memory, address_start, data):
-                if reporthook:
-                    done += address_stop - address_start
-                    reporthook('Write ', done, length)
-            else:
-                raise Exception('Write Error')
+    for address, data in image.chunks():
+        if _try_run(api, 6, api.write_memory, address, data):
+            done += len(data)
+            if reporthook:
+                reporthook('Write ', done, length)
+        else:
+            raise Exception('Write Error')
 
     if skip_verify:
         return
@@ -543,50 +569,34 @@ def _flash_hex(device, filename, reporthook, api, skip_verify):
 
     done = 0
 
-    for s in segments:
-        sih = ih[s[0]:s[1]]
-        for address_start in range(s[0], s[1], 128):
-            address_stop = address_start + 128
-            if address_stop > s[1]:
-                address_stop = s[1]
-
-            data = sih[address_start:address_stop].tobinstr()
-
-            for i in range(2):
-                vdata = _try_run(api, 6, api.read_memory, address_start, len(data))
-                if vdata == data:
-                    if reporthook:
-                        done += address_stop - address_start
-                        reporthook('Verify', done, length)
-                    break
-            else:
-                raise Exception('Verify Error')
-
+    for address, data in image.chunks():
+        for i in range(2):
+            vdata = _try_run(api, 6, api.read_memory, address, len(data))
+            if vdata == data:
+                done += len(data)
+                if reporthook:
+                    reporthook('Verify', done, length)
+                break
+        else:
+            raise Exception('Verify Error')
 
-def flash(device, filename, run=True, reporthook=None, erase_eeprom=False, unprotect=False, skip_verify=False, diff=False, baudrate=921600):
-    api = Flash_Serial(device, baudrate)
 
-    _run_connect(api)
+def flash(device, filename, run=True, reporthook=None, erase_eeprom=False, unprotect=False, skip_verify=False, diff=False, baudrate=921600, eeprom=None, cache_dir=None):
+    with Flasher(device, baudrate, reporthook=reporthook, cache_dir=cache_dir) as flasher:
+        if unprotect:
+            flasher.unprotect()
 
-    if unprotect:
-        _unprotect(device, api)
+        if erase_eeprom:
+            flasher.eeprom_erase()
 
-    if erase_eeprom:
-        eeprom_erase(device, reporthook=reporthook, run=False, api=api)
+        if filename:
+            flasher.flash(filename, skip_verify=skip_verify, diff=diff)
 
-    if filename.endswith(".hex"):
-        if diff:
-            raise Exception('Diff is not implemented')
-        else:
-            _flash_hex(device, filename, reporthook, api, skip_verify)
-    else:
-        if diff:
-            _flash_bin_diff(device, filename, reporthook, api)
-        else:
-            _flash_bin(device, filename, reporthook, api, skip_verify)
+        for address, data in eeprom or []:
+            flasher.eeprom_write(data, address=address)
 
-    if run:
-        api.go(0x08000000)
+        if run:
+            flasher.go()
 
 
 def reset(device, baudrate=921600):
@@ -612,31 +622,10 @@ def eeprom_read(device, filename, address=0, length=6144, reporthook=None, run=T
         api = Flash_Serial(device, baudrate)
         _run_connect(api)
 
-    start_address = 0x08080000 + address
+    data = read(device, length, reporthook=reporthook, api=api, start_address=0x08080000 + address, label=label)
 
-    if reporthook:
-        reporthook(label, 0, length)
-
-    f = open(filename, 'wb')
-    step = 128
-    for offset in range(0, length, step):
-        read_len = length - offset
-        if read_len > step:
-            read_len = step
-
-        for i in range(2):
-            data = _try_run(api, 6, api.read_memory, start_address + offset, read_len)
-            verify = _try_run(api, 6, api.read_memory, start_address + offset, read_len)
-            if data == verify:
-                f.write(data)
-                break
-        else:
-            raise Exception(label + ' Error')
-
-        if reporthook:
-            reporthook(label, offset + read_len, length)
-
-    f.close()
+    with open(filename, 'wb') as f:
+        f.write(data)
 
     if run:
         api.go(0x08000000)
@@ -651,24 +640,15 @@ def eeprom_write(device, filename, address=0, length=6144, reporthook=None, run=
         _run_connect(api)
 
     with open(filename, 'rb') as f:
-        data = f.read(length)
+        data = f.read()
 
-    start_address = 0x08080000 + address
+    # A full EEPROM dump is sliced at address, other files hold just the region.
+    if len(data) == 6144:
+        data = data[address:]
 
-    if reporthook:
-        reporthook(label, 0, length)
+    data = data[:length]
 
-    step = 128
-    for offset in range(0, length, step):
-        write_len = length - offset
-        if write_len > step:
-            write_len = step
-
-        if _try_run(api, 6, api.write_memory, start_address + offset, data[offset:offset + write_len]):
-            if reporthook:
-                reporthook(label, offset + write_len, length)
-        else:
-            raise Exception(label + ' Error')
+    eeprom_update(device, data, address, reporthook=reporthook, api=api, label=label)
 
     if run:
         api.go(0x08000000)
@@ -679,25 +659,176 @@ def eeprom_erase(device, reporthook=None, run=True, api=None, baudrate=921600, l
         api = Flash_Serial(device, baudrate)
         _run_connect(api)
 
-    length = 6144
+    eeprom_update(device, bytes([0xff] * 6144), 0, reporthook=reporthook, api=api, label=label)
 
-    start_address = 0x08080000
+    if run:
+        api.go(0x08000000)
 
-    if reporthook:
-        reporthook(label, 0, length)
 
-    step = 128
-    data = bytearray([0xff] * 128)
-    for offset in range(0, length, step):
-        write_len = length - offset
-        if write_len > step:
-            write_len = step
+def eeprom_patch(device, patches, reporthook=None, run=True, baudrate=921600):
+    with Flasher(device, baudrate, reporthook=reporthook) as flasher:
+        for address, data in patches:
+            flasher.eeprom_write(data, address=address)
 
-        if _try_run(api, 6, api.write_memory, start_address + offset, data):
+        if run:
+            flasher.go()
+
+
+def eeprom_update(device, data, address=0, reporthook=None, api=None, cache=None, label='Write EEPROM'):
+    '''Write only the 4-byte aligned words of EEPROM which differ from data.
+
+    The current content is read from the device, or taken from cache, which is
+    a bytearray copy of the whole EEPROM and is updated after the write.
+    '''
+    if api is None:
+        api = Flash_Serial(device)
+        _run_connect(api)
+
+    start = address - address % 4
+    stop = address + len(data)
+    stop += -stop % 4
+
+    if cache is None:
+        current = read(device, stop - start, reporthook=reporthook, api=api, start_address=0x08080000 + start, label='Compare EEPROM', step=256)
+    else:
+        current = bytes(cache[start:stop])
+
+    desired = bytearray(current)
+    desired[address - start:address - start + len(data)] = data
+
+    runs = _diff_runs(current, desired)
+
+    length = sum(len(chunk) for offset, chunk in runs)
+
+    if reporthook:
+        reporthook(label, 0, length or 1)
+
+    done = 0
+    for offset, chunk in runs:
+        if _try_run(api, 6, api.write_memory, 0x08080000 + start + offset, chunk):
+            done += len(chunk)
             if reporthook:
-                reporthook(label, offset + write_len, length)
+                reporthook(label, done, length)
         else:
             raise Exception(label + ' Error')
 
-    if run:
-        api.go(0x08000000)
+    if not runs and reporthook:
+        reporthook(label, 1, 1)
+
+    if cache is not None:
+        cache[start:stop] = desired
+
+
+def _diff_runs(current, desired, frame=256, gap=16):
+    '''Split the differing 4-byte words into runs of at most frame bytes.
+
+    Runs separated by no more than gap equal bytes are merged, as one write
+    frame is cheaper than two round trips.
+    '''
+    runs = []
+    for offset in range(0, len(desired), 4):
+        if current[offset:offset + 4] == desired[offset:offset + 4]:
+            continue
+        if runs and offset - runs[-1][1] <= gap and offset + 4 - runs[-1][0] <= frame:
+            runs[-1][1] = offset + 4
+        else:
+            runs.append([offset, offset + 4])
+
+    return [(start, bytes(desired[start:stop])) for start, stop in runs]
+
+
+class Flasher(object):
+    '''Bootloader session, connects once and runs any sequence of operations.
+
+    with Flasher('/dev/ttyUSB0', reporthook=print_progress_bar) as flasher:
+        flasher.flash('firmware.bin')
+        flasher.eeprom_write(b'\x01\x02\x03\x04', address=16)
+        flasher.go()
+
+    The reporthook is called as reporthook(label, progress, total), parsed
+    hex files are cached in cache_dir.
+    '''
+
+    def __init__(self, device, baudrate=921600, reporthook=None, cache_dir=None):
+        self.device = device
+        self.reporthook = reporthook
+        self.cache_dir = cache_dir
+        self.api = Flash_Serial(device, baudrate)
+        self._opened = False
+        self._eeprom = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if not self._opened:
+            _run_connect(self.api)
+            self._opened = True
+
+    def close(self):
+        self._opened = False
+        self.api.close()
+
+    def unprotect(self):
+        self.open()
+        self._eeprom = None
+        _unprotect(self.device, self.api)
+
+    def erase(self, length=196608):
+        self.open()
+        erase(self.device, length, reporthook=self.reporthook, api=self.api)
+
+    def write(self, data, start_address=0x08000000):
+        self.open()
+        write(self.device, data, reporthook=self.reporthook, api=self.api, start_address=start_address)
+
+    def verify(self, data, start_address=0x08000000):
+        self.open()
+        verify(self.device, data, reporthook=self.reporthook, api=self.api, start_address=start_address)
+
+    def read(self, length, start_address=0x08000000):
+        self.open()
+        return read(self.device, length, reporthook=self.reporthook, api=self.api, start_address=start_address)
+
+    def flash(self, filename, skip_verify=False, diff=False):
+        self.open()
+        self._eeprom = None
+        image = fimage.load(filename, self.cache_dir)
+        if diff:
+            _flash_image_diff(self.device, image, self.reporthook, self.api)
+        else:
+            _flash_image(self.device, image, self.reporthook, self.api, skip_verify)
+
+    def eeprom_read(self, address=0, length=6144):
+        _check_eeprom_range(address, length)
+        if self._eeprom is not None:
+            return bytes(self._eeprom[address:address + length])
+        self.open()
+        data = read(self.device, length, reporthook=self.reporthook, api=self.api, start_address=0x08080000 + address, label='Read EEPROM', step=256)
+        if address == 0 and length == 6144:
+            self._eeprom = bytearray(data)
+        return data
+
+    def eeprom_write(self, data, address=0):
+        _check_eeprom_range(address, len(data))
+        self.open()
+        eeprom_update(self.device, data, address, reporthook=self.reporthook, api=self.api, cache=self._eeprom)
+
+    def eeprom_erase(self):
+        self.eeprom_write(bytes([0xff] * 6144))
+
+    def go(self, start_address=0x08000000):
+        self.open()
+        return self.api.go(start_address)
+
+
+def _check_eeprom_range(address, length):
+    if 0 > address or address >= 6144:
+        raise Exception('Bad address, max: 6144')
+
+    if 0 >= length or address + length > 6144:
+        raise Exception('Bad length, max: 6144')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Benchmark of the serial log reader on a pseudo terminal.
+
+    python3 -m bcf.log.benchmark [seconds per run]
+
+A thread writes log lines to the master side of a pty at the byte rate of
+the baudrate, the reader under test reads the slave side and prints to
+/dev/null. Reported are the lines printed per second and the CPU time of
+the reader thread as a percentage of the run time.
+'''
+import os
+import sys
+import time
+import threading
+import serial
+from .log import Log, SerialPortLog
+
+LINE = b'# 12345.67 <I> sensor: temperature 23.25 C, humidity 45.2 %\r\n'
+
+
+class Stop(Exception):
+    pass
+
+
+class Port(object):
+    '''Serial port stopping the reader at deadline.'''
+
+    def __init__(self, path, deadline):
+        self.ser = serial.Serial(path, timeout=3)
+        self.deadline = deadline
+        self.reset_input_buffer = self.ser.reset_input_buffer
+
+    @property
+    def in_waiting(self):
+        return self.ser.in_waiting
+
+    def read(self, size=1):
+        if time.monotonic() > self.deadline:
+            raise Stop()
+        return self.ser.read(size)
+
+    def readline(self):
+        if time.monotonic() > self.deadline:
+            raise Stop()
+        return self.ser.readline()
+
+
+def legacy_run(log):
+    '''The reader before the chunked one, a line per readline().'''
+    while True:
+        line = log.ser.readline()
+        if not line:
+            continue
+        log.print(line.decode(errors='backslashreplace'))
+
+
+def writer(fd, baudrate, stop):
+    rate = baudrate / 10  # bytes per second, 8N1
+    lines = 0
+    pending = b''
+    start = time.monotonic()
+    os.set_blocking(fd, False)
+    while not stop.is_set():
+        due = int((time.monotonic() - start) * rate / len(LINE)) - lines
+        if due > 0:
+            pending += LINE * due
+            lines += due
+        if pending:
+            try:
+                pending = pending[os.write(fd, pending[:65536]):]
+            except BlockingIOError:
+                pass  # the reader does not keep up
+        time.sleep(0.005)
+
+
+def measure(reader, baudrate, seconds):
+    master, slave = os.openpty()
+    stop = threading.Event()
+    result = {}
+
+    log = SerialPortLog.__new__(SerialPortLog)
+    Log.__init__(log, True, False, None, False)
+    log.ser = Port(os.ttyname(slave), time.monotonic() + seconds)
+
+    printed = [0]
+    print_lines = log.print_lines
+
+    def counting_print_lines(lines):
+        printed[0] += len(lines)
+        print_lines(lines)
+
+    log.print_lines = counting_print_lines
+
+    def run():
+        cpu = time.thread_time()
+        try:
+            reader(log)
+        except Stop:
+            pass
+        result['cpu'] = time.thread_time() - cpu
+
+    thread = threading.Thread(target=writer, args=(master, baudrate, stop), daemon=True)
+    thread.start()
+    run()
+    stop.set()
+    thread.join()
+
+    log.ser.ser.close()
+    os.close(master)
+    os.close(slave)
+
+    return printed[0] / seconds, 100 * result['cpu'] / seconds
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    stdout = sys.stdout
+    devnull = open(os.devnull, 'w')
+
+    for baudrate in (115200, 921600, 3000000):
+        for label, reader in (('readline', legacy_run), ('chunked', SerialPortLog.run)):
+            sys.stdout = devnull
+            try:
+                lines, cpu = measure(reader, baudrate, seconds)
+            finally:
+                sys.stdout = stdout
+            print('%8d baud %-9s %9.0f lines/s %6.1f %% CPU' % (baudrate, label, lines, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,24 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import serial
+import signal
 from datetime import datetime
 from time import sleep
 import click
 from colorama import init, Fore, Style
-from ..flasher.serialport.ftdi import SerialPort
+from . import record
+from ..utils import parse_size
 
 
 BAUDRATE = 115200
+
+# Below this many bytes per read the reader sleeps BATCH_INTERVAL seconds to
+# let more data arrive, so a slow stream wakes it up only a few times per
+# second and a fast one is read in large chunks without delay.
+BATCH_SIZE = 1024
+BATCH_INTERVAL = 0.05
+# Longest line kept in the buffer while waiting for its end.
+MAX_LINE = 65536
 log_level_color_lut = {'X': Fore.BLUE, 'D': Fore.MAGENTA, 'I': Fore.GREEN, 'W': Fore.YELLOW, 'E': Fore.RED}
 
 
@@ -20,11 +29,27 @@ def test(ctx, param, value):
     return value
 
 
+def _parse(parser):
+    def callback(ctx, param, value):
+        value = test(ctx, param, value)
+        if value is None:
+            return None
+        try:
+            return parser(value)
+        except ValueError:
+            raise click.BadParameter('%s is not valid' % value)
+    return callback
+
+
 def click_options(f):
     f = click.option('--time', is_flag=True, help='Show time.', callback=test)(f)
     f = click.option('--no-color', is_flag=True, help='Disable color.', callback=test)(f)
     f = click.option('--raw', is_flag=True, help='Print raw.', callback=test)(f)
-    return click.option('--record', help='Record to file.', callback=test)(f)
+    f = click.option('--record', help='Record to file.', callback=test)(f)
+    f = click.option('--record-max-size', help='Rotate record file at size, e.g. 100M.', callback=_parse(parse_size))(f)
+    f = click.option('--record-max-age', help='Rotate record file at age, seconds or with unit s/m/h/d, e.g. 1d.', callback=_parse(record.parse_duration))(f)
+    f = click.option('--record-compress', type=click.Choice(record.COMPRESS), help='Compress rotated record files, zstd needs the zstandard package.', callback=test)(f)
+    return click.option('--record-flush', help='Record flush interval in seconds [default: 1].', callback=_parse(float))(f)
 
 
 class Log(object):
@@ -44,50 +69,61 @@ class Log(object):
         else:
             return ""
 
-    def print(self, line):
-        if line[0] == '#' and line.endswith('\r\n'):
+    def format(self, line, time):
+        '''Return (output, record) text of line, both None when the line is not shown.'''
+        if line[:1] == '#' and line.endswith('\r\n'):
             line = line[1:].strip()
 
             index = line.find("<")
 
             if index < 0:
-                return
+                return None, None
 
-            time = self.get_time_str()
-
-            if self._record_file:
-                self._record_file.write(time + line + os.linesep)
-                self._record_file.flush()
+            record = time + line + os.linesep
 
             if self._no_color:
-                click.echo(time + line)
-            else:
-                if index < 0:
-                    click.echo(time + line)
+                return time + line + '\n', record
 
-                else:
-                    color = ""
-                    try:
-                        level_char = line[index + 1]
-                        color = log_level_color_lut[level_char]
-                    except Exception as e:
-                        pass
+            color = log_level_color_lut.get(line[index + 1:index + 2], "")
 
-                    click.echo(color + time + line[:index + 3] + Style.RESET_ALL + line[index + 3:])
+            return color + time + line[:index + 3] + Style.RESET_ALL + line[index + 3:] + '\n', record
 
         elif self._raw:
-            time = self.get_time_str()
+            return time + line.rstrip() + '\n', time + line
 
-            if self._record_file:
-                self._record_file.write(time + line)
+        return None, None
+
+    def print(self, line):
+        self.print_lines([line])
+
+    def print_lines(self, lines):
+        '''Print lines with one write to the output and to the record file.'''
+        time = self.get_time_str()
+        output = []
+        record = []
+
+        for line in lines:
+            out, rec = self.format(line, time)
+            if out is not None:
+                output.append(out)
+                record.append(rec)
+
+        if not output:
+            return
+
+        if self._record_file:
+            self._record_file.write(''.join(record))
+            # RecordFile flushes by its interval, plain files per batch.
+            if not hasattr(self._record_file, 'poll'):
                 self._record_file.flush()
 
-            click.echo(time + line.rstrip())
+        click.echo(''.join(output), nl=False)
 
 
 class SerialPortLog(Log):
     def __init__(self, device, show_time, no_color, raw, record_file):
         Log.__init__(self, show_time, no_color, record_file, raw)
+        from ..flasher.serialport.ftdi import SerialPort
         if isinstance(device, SerialPort):
             self.ser = device
         else:
@@ -99,18 +135,37 @@ class SerialPortLog(Log):
     def run(self):
         self.ser.reset_input_buffer()
 
+        buffer = bytearray()
+
         while True:
-            line = self.ser.readline()
+            # Blocks until at least one byte arrives or the port timeout passes.
+            data = self.ser.read(max(1, self.ser.in_waiting))
+
+            if data:
+                buffer += data
+                end = buffer.rfind(b'\n') + 1
+                if not end and len(buffer) >= MAX_LINE:
+                    end = len(buffer)
+            else:
+                # Quiet for the port timeout, print unfinished line as readline did.
+                end = len(buffer)
+                if hasattr(self._record_file, 'poll'):
+                    self._record_file.poll()
 
-            if not line:
-                continue
+            if end:
+                text = buffer[:end].decode(errors='backslashreplace')
+                del buffer[:end]
 
-            try:
-                line = line.decode(errors='backslashreplace')
-            except Exception as e:
-                continue
+                lines = text.split('\n')
+                last = lines.pop()
+                lines = [line + '\n' for line in lines]
+                if last:
+                    lines.append(last)
 
-            self.print(line)
+                self.print_lines(lines)
+
+            if data and len(data) < BATCH_SIZE:
+                sleep(BATCH_INTERVAL)
 
 
 def run(device, show_time=True, no_color=False, raw=False, record_file=None, reset=False):
@@ -122,11 +177,24 @@ def run(device, show_time=True, no_color=False, raw=False, record_file=None, res
 
 
 def run_args(device, args, reset=False):
+    record_file = None
     try:
-        record_file = open(args['record'], 'a') if args['record'] else None
+        if args['record']:
+            record_file = record.RecordFile(args['record'],
+                                            max_size=args['record_max_size'] or 0,
+                                            max_age=args['record_max_age'] or 0,
+                                            compress=args['record_compress'],
+                                            flush_interval=1.0 if args['record_flush'] is None else args['record_flush'])
+
+            # Terminated soak tests flush the record like on Ctrl+C.
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
         if device:
             run(device, args['time'], args['no_color'], args['raw'], record_file, reset)
 
     except KeyboardInterrupt as e:
         sys.exit(1)
+
+    finally:
+        if record_file:
+            record_file.close()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+
+COMPRESS = ('gzip', 'zstd')
+
+_durations = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400}
+
+
+def parse_duration(value):
+    '''Parse seconds, or number with unit s, m, h or d.'''
+    value = value.strip().upper()
+    if value and value[-1] in _durations:
+        return float(value[:-1]) * _durations[value[-1]]
+    return float(value)
+
+
+class RecordFile(object):
+    '''Log record sink, appends to filename.
+
+    Writes are buffered and flushed every flush_interval seconds. The file is
+    rotated when it grows over max_size bytes or is older than max_age
+    seconds (0 disables), the segment is renamed to filename.YYYYmmdd-HHMMSS
+    and compressed by gzip or zstd in a background thread. close() flushes and
+    waits for the compression.
+    '''
+
+    def __init__(self, filename, max_size=0, max_age=0, compress=None, flush_interval=1.0):
+        if compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception('Compression zstd requires the zstandard package.')
+        if compress not in (None, ) + COMPRESS:
+            raise Exception('Unknown compression %s' % compress)
+
+        self._filename = filename
+        self._max_size = max_size
+        self._max_age = max_age
+        self._compress = compress
+        self._flush_interval = flush_interval
+        self._threads = []
+        self._fd = None
+        self._open()
+
+    def _open(self):
+        self._fd = open(self._filename, 'a', encoding='utf-8', buffering=65536)
+        self._size = self._fd.tell()
+        self._opened = time.time()
+        self._flushed = time.monotonic()
+
+    def write(self, text):
+        if (self._max_size and self._size >= self._max_size) or (self._max_age and time.time() - self._opened >= self._max_age):
+            self.rotate()
+
+        self._fd.write(text)
+        self._size += len(text)
+
+        if time.monotonic() - self._flushed >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''Flush buffered records to the file.'''
+        self._fd.flush()
+        self._flushed = time.monotonic()
+
+    def poll(self):
+        '''Flush when flush_interval passed, for the reader to call while the log is quiet.'''
+        if time.monotonic() - self._flushed >= self._flush_interval:
+            self.flush()
+
+    def rotate(self):
+        self._fd.close()
+
+        segment = self._filename + time.strftime('.%Y%m%d-%H%M%S', time.localtime(self._opened))
+        name = segment
+        i = 1
+        while os.path.exists(name) or os.path.exists(name + '.gz') or os.path.exists(name + '.zst'):
+            name = '%s.%d' % (segment, i)
+            i += 1
+        os.replace(self._filename, name)
+
+        if self._compress:
+            thread = threading.Thread(target=_compress, args=(name, self._compress))
+            thread.start()
+            self._threads = [t for t in self._threads if t.is_alive()] + [thread]
+
+        self._open()
+
+    def close(self):
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _compress(filename, compress):
+    if compress == 'zstd':
+        import zstandard
+        with open(filename, 'rb') as src, open(filename + '.zst', 'wb') as dst:
+            zstandard.ZstdCompressor().copy_stream(src, dst)
+    else:
+        import gzip
+        import shutil
+        with open(filename, 'rb') as src, gzip.open(filename + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+    os.unlink(filename)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import tempfile
+import threading
+import concurrent.futures
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to wait for connect and for each read.
+TIMEOUT = float(os.getenv('BCF_HTTP_TIMEOUT', '30'))
+RETRIES = int(os.getenv('BCF_HTTP_RETRIES', '3'))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''Return the keep-alive session shared by all network access.'''
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=16, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+
+    return _session
+
+
+def get(url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    kwargs.setdefault('allow_redirects', True)
+    return get_session().head(url, **kwargs)
+
+
+class Transport(object):
+    '''HTTP transport used for downloads, can be replaced for testing.
+
+    get() returns an object with status_code, headers, iter_content(chunk_size)
+    and close(), like requests.Response.
+    '''
+
+    def __init__(self, session=None):
+        self._session = session or get_session()
+
+    def get(self, url, headers=None):
+        # Identity encoding, so Content-Length, Range offsets and the hash of
+        # iter_content() all count the same bytes.
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'identity'
+        return self._session.get(url, headers=headers, stream=True, allow_redirects=True, timeout=TIMEOUT)
+
+
+class HostLimit(object):
+    '''Semaphores limiting concurrent requests per host, used as `with host_limit(url):`.'''
+
+    def __init__(self, per_host):
+        self._per_host = per_host
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        with self._lock:
+            return self._hosts.setdefault(urlparse(url).netloc, threading.Semaphore(self._per_host))
+
+
+class UrlChecker(object):
+    '''Check availability of urls concurrently.
+
+    HEAD is tried first and GET when HEAD fails, since some servers do not
+    support it. Available urls are remembered in cache_file for ttl seconds.
+    '''
+
+    def __init__(self, cache_file=None, ttl=3600, jobs=16, per_host=4):
+        self._cache_file = cache_file
+        self._ttl = ttl
+        self._jobs = jobs
+        self._per_host = per_host
+        self._results = {}
+        self._cache = {}
+
+        if cache_file:
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as fd:
+                    self._cache = json.load(fd)
+            except Exception:
+                pass
+
+    def check(self, urls):
+        '''Return dict of url to status code, None when the server is not reachable.'''
+        now = time.time()
+        todo = []
+        for url in dict.fromkeys(urls):
+            if url in self._results:
+                continue
+            if url in self._cache and now - self._cache[url] < self._ttl:
+                self._results[url] = 200
+                continue
+            todo.append(url)
+
+        if todo:
+            host_limit = HostLimit(self._per_host)
+
+            def check_url(url):
+                with host_limit(url):
+                    return self._check_url(url)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs) as executor:
+                for url, status in zip(todo, executor.map(check_url, todo)):
+                    self._results[url] = status
+                    if is_ok(status):
+                        self._cache[url] = now
+
+            self._save_cache()
+
+        return {url: self._results[url] for url in urls}
+
+    def _check_url(self, url):
+        try:
+            response = head(url)
+            if is_ok(response.status_code):
+                return response.status_code
+            response = get(url, stream=True)
+            response.close()
+            return response.status_code
+        except requests.exceptions.RequestException:
+            return None
+
+    def _save_cache(self):
+        if not self._cache_file:
+            return
+        directory = os.path.dirname(self._cache_file)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(self._cache, f)
+        os.replace(tmp, self._cache_file)
+
+
+def is_ok(status):
+    return status in (200, 204)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import threading
+
+# Redraws per second on a terminal.
+RATE = float(os.getenv('BCF_PROGRESS_RATE', '10'))
+# Seconds between JSON events of one bar when output is not a terminal.
+INTERVAL = float(os.getenv('BCF_PROGRESS_INTERVAL', '2'))
+
+
+class Progress(object):
+    '''Progress bars of concurrent jobs written to one stream.
+
+    update() only records the state, bars are drawn at most RATE times per
+    second and when a bar starts or completes. A completed bar is printed
+    once more and the next update with the same key starts a new bar, the key
+    is the title unless given.
+    When the stream is not a terminal, JSON events are written instead: start,
+    progress at most every INTERVAL seconds per bar, and done.
+    '''
+
+    def __init__(self, stream=None, json_events=None, length=20, rate=RATE, interval=INTERVAL):
+        self._stream = stream or sys.stdout
+        if json_events is None:
+            json_events = not (hasattr(self._stream, 'isatty') and self._stream.isatty())
+        self._json = json_events
+        self.length = length
+        self._period = 1.0 / rate if rate > 0 else 0
+        self._interval = interval
+        self._bars = {}
+        self._lines = 0
+        self._width = 0
+        self._last_draw = 0
+        self._lock = threading.Lock()
+
+    def update(self, title, progress, total, unit='B', key=None):
+        '''Record progress of the bar title, usable as reporthook(title, progress, total).'''
+        now = time.monotonic()
+        if key is None:
+            key = title
+        with self._lock:
+            bar = self._bars.get(key)
+            if bar is None:
+                bar = self._bars[key] = {'key': key, 'title': title, 'unit': unit, 'start': now, 'event': 0}
+                new = True
+            else:
+                new = False
+
+            bar['progress'] = max(0, min(progress, total)) if total > 0 else 0
+            bar['total'] = total
+            bar['done'] = total <= 0 or progress >= total
+
+            if self._json:
+                if new or bar['done'] or now - bar['event'] >= self._interval:
+                    bar['event'] = now
+                    self._write_event(bar, now, 'done' if bar['done'] else 'start' if new else 'progress')
+                if bar['done']:
+                    del self._bars[key]
+            elif new or bar['done'] or now - self._last_draw >= self._period:
+                self._last_draw = now
+                self._draw(now)
+
+    def close(self):
+        '''Finish all bars, the incomplete ones stay as they are.'''
+        with self._lock:
+            if self._json:
+                self._bars.clear()
+                return
+            for bar in self._bars.values():
+                bar['done'] = True
+            self._draw(time.monotonic())
+
+    def _draw(self, now):
+        done = [bar for bar in self._bars.values() if bar['done']]
+        active = [bar for bar in self._bars.values() if not bar['done']]
+
+        lines = [self._format(bar, now) for bar in done + active]
+        self._width = max([self._width] + [len(line) for line in lines])
+
+        out = ''
+        if self._lines > 1:
+            out += '\x1b[%dA' % (self._lines - 1)
+        out += '\r' + '\n'.join(line.ljust(self._width) for line in lines)
+
+        for bar in done:
+            del self._bars[bar['key']]
+
+        self._lines = len(active)
+        if not active:
+            out += '\n'
+
+        self._stream.write(out)
+        self._stream.flush()
+
+    def _format(self, bar, now):
+        progress, total = bar['progress'], bar['total']
+        ratio = progress / total if total > 0 else 1
+        filled = int(self.length * ratio)
+        line = '%s [%s%s] %5.1f%%' % (bar['title'], '#' * filled, '-' * (self.length - filled), 100 * ratio)
+
+        elapsed = now - bar['start']
+        if elapsed > 0.5 and progress:
+            rate = progress / elapsed
+            line += '  %s/s' % _format_amount(rate, bar['unit'])
+            if not bar['done']:
+                line += '  ETA %s' % _format_time((total - progress) / rate)
+        return line
+
+    def _write_event(self, bar, now, event):
+        elapsed = now - bar['start']
+        rate = bar['progress'] / elapsed if elapsed > 0 else None
+        data = {
+            'event': event,
+            'title': bar['title'],
+            'progress': bar['progress'],
+            'total': bar['total'],
+            'unit': bar['unit'],
+            'rate': round(rate, 1) if rate else None,
+            'eta': round((bar['total'] - bar['progress']) / rate, 1) if rate else None,
+        }
+        self._stream.write(json.dumps(data) + '\n')
+        self._stream.flush()
+
+
+def _format_amount(value, unit):
+    if unit != 'B':
+        return '%.1f %s' % (value, unit)
+    for prefix in ('', 'k', 'M'):
+        if value < 1000:
+            break
+        value /= 1000
+    return '%.1f %sB' % (value, prefix)
+
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return '%d:%02d' % (seconds // 60, seconds % 60)
+
+
+_default = None
+
+
+def get_progress():
+    '''Return the Progress shared by the CLI, writing to stdout.'''
+    global _default
+    if _default is None:
+        _default = Progress()
+    return _default
+
+
+if __name__ == '__main__':
+    # Benchmark: python3 bcf/progress.py, reporthook per 128 B block of 192 KiB flash, 8 devices.
+    calls = 192 * 1024 // 128
+    devices = 8
+
+    class Stream(object):
+        def __init__(self):
+            self.fd = open(os.devnull, 'w')
+            self.size = 0
+
+        def write(self, data):
+            self.size += len(data)
+            self.fd.write(data)
+
+        def flush(self):
+            self.fd.flush()
+
+    for label, json_events in (('per call redraw', None), ('throttled tty', False), ('throttled json', True)):
+        stream = Stream()
+        progress = Progress(stream, json_events=json_events)
+        t = time.perf_counter()
+        for i in range(1, calls + 1):
+            for d in range(devices):
+                if json_events is None:
+                    stream.write('\r\rWrite %d [%s] %5.1f%%' % (d, '#' * (20 * i // calls), 100.0 * i / calls))
+                    stream.flush()
+                else:
+                    progress.update('Write %d' % d, i * 128, calls * 128)
+        print('%-16s %8.1f ms %8d bytes written' % (label, (time.perf_counter() - t) * 1000, stream.size))
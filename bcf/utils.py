@@ -2,30 +2,94 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import serial
 import click
-import requests
-import hashlib
 import appdirs
 import re
-try:
-    from packaging.version import parse as parse_version
-except ImportError:
-    from distutils.version import LooseVersion as parse_version
-
-from bcf.firmware.FirmwareList import FirmwareList
+from bcf.cache import Cache
 
 user_cache_dir = appdirs.user_cache_dir('bcf')
 user_config_dir = appdirs.user_config_dir('bcf')
 
-pyserial_34 = parse_version(serial.VERSION) >= parse_version("3.4.0")
 
+def parse_size(value):
+    '''Parse bytes, or number with unit K, M or G.'''
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def get_cache_limits():
+    '''Return (max_size, max_age) of the download cache from BCF_CACHE_MAX_SIZE and BCF_CACHE_MAX_AGE_DAYS, 0 disables the limit.'''
+    value = os.getenv('BCF_CACHE_MAX_SIZE', '512M')
+    try:
+        max_size = parse_size(value)
+    except ValueError:
+        raise Exception('Bad BCF_CACHE_MAX_SIZE=%s, use bytes or number with unit K, M or G.' % value)
+
+    value = os.getenv('BCF_CACHE_MAX_AGE_DAYS', '90')
+    try:
+        max_age = float(value) * 86400
+    except ValueError:
+        raise Exception('Bad BCF_CACHE_MAX_AGE_DAYS=%s, use number of days.' % value)
+
+    return max_size, max_age
+
+
+def get_fwlist(refresh='background'):
+    '''Return FirmwareList, refresh is the policy used when the list is missing or old, see FirmwareList.'''
+    from bcf.firmware.FirmwareList import FirmwareList
+    return FirmwareList(user_cache_dir, user_config_dir, refresh)
+
+
+def complete_firmware(incomplete, versions=True):
+    '''Complete firmware names from the sorted index written by FirmwareList, without loading the list.
+
+    With versions the name:latest items are returned, or all name:version
+    items once incomplete contains a colon; without versions only names.
+    '''
+    import bisect
+    try:
+        with open(os.path.join(user_cache_dir, 'firmware_list.complete'), 'r', encoding='utf-8') as fd:
+            index = fd.read().split('\n')
+    except OSError:
+        return []
+
+    items = []
+    for i in range(bisect.bisect_left(index, incomplete), len(index)):
+        item = index[i]
+        if not item.startswith(incomplete):
+            break
+        if ':' in item:
+            if not versions or (':' not in incomplete and not item.endswith(':latest')):
+                continue
+        elif versions:
+            continue
+        items.append(item)
+
+    return items
 
-def get_fwlist():
-    return FirmwareList(user_cache_dir, user_config_dir)
+
+def complete_files(incomplete, extensions):
+    '''Complete paths of files with one of the extensions.'''
+    directory, prefix = os.path.split(incomplete)
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names) if name.startswith(prefix) and name.endswith(extensions)]
 
 
 def get_devices(include_links=False):
+    import serial
+    try:
+        from packaging.version import parse as parse_version
+    except ImportError:
+        from distutils.version import LooseVersion as parse_version
+
+    pyserial_34 = parse_version(serial.VERSION) >= parse_version("3.4.0")
+
     if os.name == 'nt' or sys.platform == 'win32':
         from serial.tools.list_ports_windows import comports
     elif os.name == 'posix':
@@ -84,37 +148,72 @@ def download_url_reporthook(count, blockSize, totalSize):
 
 
 def download_url(url, use_cache=True):
-    if url.startswith("https://github.com/bigclownlabs/bcf-"):
-        filename = url.rsplit('/', 1)[1]
-    else:
-        filename = hashlib.sha256(url.encode()).hexdigest()
-    filename_bin = os.path.join(user_cache_dir, filename)
+    cache = Cache(user_cache_dir)
+    max_size, max_age = get_cache_limits()
 
-    if use_cache and os.path.exists(filename_bin):
-        return filename_bin
+    if use_cache:
+        filename_bin = cache.get(url)
+        if filename_bin:
+            return filename_bin
 
     click.echo('Download firmware from ' + url)
-    click.echo('Save as' + filename_bin)
+
+    from bcf.net import Transport
 
     try:
-        response = requests.get(url, stream=True, allow_redirects=True)
-        total_length = response.headers.get('content-length')
-        with open(filename_bin, "wb") as f:
-            if total_length is None:  # no content length header
-                f.write(response.content)
-            else:
-                dl = 0
-                total_length = int(total_length)
-                for data in response.iter_content(chunk_size=4096):
-                    dl += len(data)
-                    f.write(data)
-                    download_url_reporthook(1, dl, total_length)
+        filename_bin = cache.download(url, Transport(), revalidate=not use_cache, reporthook=download_url_reporthook)
+
+        cache.evict(max_size, max_age, keep=os.path.basename(filename_bin))
+
     except Exception as e:
-        click.echo("Firmware download problem: " + str(e.args[0]))
+        click.echo("Firmware download problem: " + str(e))
         sys.exit(1)
+
+    click.echo('Save as ' + filename_bin)
+
     return filename_bin
 
 
+def download_urls(urls, jobs=8, per_host=4):
+    '''Download urls to cache in parallel, the urls already in cache are skipped.'''
+    import concurrent.futures
+    from bcf.net import Transport, HostLimit
+
+    cache = Cache(user_cache_dir)
+    max_size, max_age = get_cache_limits()
+    transport = Transport()
+
+    urls = [url for url in dict.fromkeys(urls) if not cache.has(url)]
+    if not urls:
+        click.echo('All firmware is in cache')
+        return
+
+    host_limit = HostLimit(per_host)
+
+    def download(url):
+        with host_limit(url):
+            title = '  ' + url.rsplit('/', 1)[-1][:30]
+            return cache.download(url, transport, reporthook=lambda count, done, total: print_progress_bar(title, done, total, key=url))
+
+    errors = []
+    print_progress_bar('Download', 0, len(urls), unit='file')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(download, url): url for url in urls}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((futures[future], e))
+            print_progress_bar('Download', done, len(urls), unit='file')
+
+    cache.evict(max_size, max_age)
+
+    if errors:
+        for url, e in errors:
+            click.echo("Firmware download problem: %s %s" % (url, e))
+        sys.exit(1)
+
+
 def print_table(labels, rows):
     if not labels and not rows:
         return
@@ -138,22 +237,46 @@ def print_table(labels, rows):
         click.echo(row_format.format(*row))
 
 
-def print_progress_bar(title, progress, total, length=20):
-    if progress > total:
-        progress = total
-    filled_length = int(length * progress // total)
-    if filled_length < 0:
-        filled_length = 0
-    bar = '#' * filled_length
-    bar += '-' * (length - filled_length)
-    percent = 100 * (progress / float(total))
-    if percent > 100:
-        percent = 100
-    elif percent < 0:
-        percent = 0
-    sys.stdout.write('\r\r')
-    sys.stdout.write(title + ' [' + bar + '] ' + "{:5.1f}%".format(percent))
-    sys.stdout.flush()
-    if percent == 100:
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+OUTPUT_FORMATS = ('table', 'json', 'jsonl', 'tsv')
+
+
+def print_rows(keys, rows, format='table', labels=None):
+    '''Print rows in format, json, jsonl and tsv are written row by row as rows are generated.
+
+    keys name the columns of machine readable formats. Returns number of rows.
+    '''
+    if format == 'table':
+        rows = list(rows)
+        print_table(labels or [], rows)
+        return len(rows)
+
+    import json
+
+    count = 0
+
+    if format == 'tsv':
+        click.echo('\t'.join(keys))
+
+    for row in rows:
+        if format == 'tsv':
+            click.echo('\t'.join(str(v).replace('\t', ' ').replace('\n', ' ') if v is not None else '' for v in row))
+        else:
+            line = json.dumps(dict(zip(keys, row)))
+            if format == 'json':
+                click.echo((',\n  ' if count else '[\n  ') + line, nl=False)
+            else:
+                click.echo(line)
+        count += 1
+
+    if format == 'json':
+        click.echo('\n]' if count else '[]')
+
+    return count
+
+
+def print_progress_bar(title, progress, total, length=20, unit='B', key=None):
+    '''Reporthook drawing progress bar of title, throttled, see bcf.progress.'''
+    from bcf.progress import get_progress
+    progress_bars = get_progress()
+    progress_bars.length = length
+    progress_bars.update(title, progress, total, unit, key)
@@ -8,6 +8,7 @@ import json
 from pprint import pprint
 from datetime import datetime
 import os
+import hashlib
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -56,3 +57,34 @@ logging.info("Save to: %s", filename)
 with open(filename, 'w') as f:
     json.dump(payload, f, indent=2)
 
+# Delta protocol (source type delta): every firmware is a content addressed
+# shard, the manifest lists their hashes in order, clients fetch only the
+# shards whose hash changed. Shards are never modified, old ones are kept for
+# clients that are in the middle of an update.
+delta_path = os.path.join(save_path, 'delta')
+os.makedirs(os.path.join(delta_path, 'shards'), exist_ok=True)
+
+manifest = {
+    "firmware": [],
+    "date": payload["date"],
+    "version": 1
+}
+
+for firmware in firmware_list:
+    shard = json.dumps(firmware, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    sha256 = hashlib.sha256(shard).hexdigest()
+    shard_name = 'shards/%s.json' % sha256
+
+    filename = os.path.join(delta_path, shard_name)
+    if not os.path.exists(filename):
+        with open(filename, 'wb') as f:
+            f.write(shard)
+
+    manifest["firmware"].append({"name": firmware["name"], "sha256": sha256, "shard": shard_name})
+
+filename = os.path.join(delta_path, 'manifest.json')
+logging.info("Save to: %s", filename)
+with open(filename + '.tmp', 'w') as f:
+    json.dump(manifest, f, indent=2)
+os.replace(filename + '.tmp', filename)
+
@@ -56,3 +56,21 @@ python3 -m pip install -r requirements-dev.txt 2>&1 \
 
 einfo 'Test codestyle'
 python3 -m pycodestyle --ignore=E501 bcf
+
+einfo 'Test startup imports'
+python3 -X importtime -c 'import bcf.cli' 2>&1 >/dev/null | python3 -c '
+import sys
+
+heavy = ("requests", "serial", "yaml", "intelhex", "pyftdi", "packaging")
+budget = 100000  # us, cumulative import time of bcf.cli
+
+for line in sys.stdin:
+    if not line.startswith("import time:") or "|" not in line:
+        continue
+    self_us, cumulative, name = line[12:].split("|")
+    name = name.strip()
+    if name.split(".")[0] in heavy:
+        sys.exit("bcf.cli imports %s at startup, import it lazily." % name)
+    if name == "bcf.cli" and int(cumulative) > budget:
+        sys.exit("import bcf.cli takes %s us, budget is %d us." % (cumulative.strip(), budget))
+'